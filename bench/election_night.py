@@ -0,0 +1,400 @@
+"""
+Election-night load test.
+
+Starts the app under gunicorn and the login mailer against a temporary
+SQLite database, with local stand-ins for the people directory and the SMTP
+relay, then runs many simulated voters through the whole journey:
+
+    GET /request_login -> POST /request_login -> (login email) -> GET /login/{token}
+    -> GET /vote/{id} -> POST /vote/{id} -> GET /
+
+and reports throughput, per-route latency percentiles, failed journeys and
+ballots that the server accepted but that never reached the database.
+
+Run from the repository root:
+
+    python -m bench.election_night --voters 1000 --concurrency 200 --workers 4
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from vote.migrations import migrate
+from vote.models import *
+
+from .stubs import StubDirectory, StubSMTP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(prog="election night benchmark")
+parser.add_argument("--voters", type=int, default=500)
+parser.add_argument("--concurrency", type=int, default=100)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--questions", type=int, default=5)
+parser.add_argument("--options", type=int, default=4)
+parser.add_argument(
+    "--past-elections",
+    type=int,
+    default=0,
+    help="closed elections (with the same shape) shown on the homepage",
+)
+parser.add_argument(
+    "--email-timeout", type=float, default=30, help="seconds to wait for a login email"
+)
+parser.add_argument("--json", help="also write the results to this file")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        self.errors: Dict[str, int] = collections.Counter()
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        route: str,
+        method: str,
+        url: str,
+        expect: int,
+        **kwargs,
+    ) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            r = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(time.perf_counter() - start)
+        if r.status_code != expect:
+            self.errors[route] += 1
+            return None
+        return r
+
+
+def setup_database(url: str, args) -> int:
+    """Creates the open election (plus any closed ones) and returns its id"""
+    engine = sqlalchemy.create_engine(url)
+    migrate(engine)
+    now = datetime.datetime.now()
+    with Session(engine) as session:
+        elections = []
+        for i in range(args.past_elections + 1):
+            is_open = i == args.past_elections
+            election = Election(
+                name=f"Benchmark election {i}",
+                visible=True,
+                open_timestamp=now - datetime.timedelta(days=2),
+                close_timestamp=now + datetime.timedelta(days=1 if is_open else -1),
+            )
+            for q in range(args.questions):
+                election.questions.append(
+                    Question(
+                        name=f"Question {q}",
+                        options=[
+                            QuestionOption(name=f"Option {o}")
+                            for o in range(args.options)
+                        ],
+                    )
+                )
+            elections.append(election)
+        session.add_all(elections)
+        session.commit()
+        election_id = elections[-1].id
+    engine.dispose()
+    return election_id
+
+
+def count_ballots(url: str, election_id: int) -> int:
+    engine = sqlalchemy.create_engine(url)
+    with Session(engine) as session:
+        count = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count())
+            .select_from(Voter)
+            .where(Voter.election_id == election_id)
+        )
+    engine.dispose()
+    return count
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def csrf_from(r: httpx.Response) -> Dict[str, str]:
+    return {
+        "form": re.search(r'name="csrf" value="([^"]+)"', r.text).group(1),
+        "cookie": r.cookies["vote_csrf"],
+    }
+
+
+async def voter_journey(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    smtp: StubSMTP,
+    kerberos: str,
+    election_id: int,
+    ballot: Dict[str, str],
+    args,
+) -> str:
+    """Returns "voted" if the server accepted the ballot, otherwise the step that failed"""
+    # The cookies are marked secure, so they are passed by hand over plain http
+    r = await recorder.request(
+        client, "GET /request_login", "GET", "/request_login", 200
+    )
+    if r is None:
+        return "request_login"
+    csrf = csrf_from(r)
+    r = await recorder.request(
+        client,
+        "POST /request_login",
+        "POST",
+        "/request_login",
+        200,
+        data={"csrf": csrf["form"], "kerberos": kerberos},
+        headers={"cookie": f"vote_csrf={csrf['cookie']}"},
+    )
+    if r is None:
+        return "request_login"
+
+    login_url = await smtp.wait_for_login_url(kerberos, args.email_timeout)
+    if login_url is None:
+        return "email"
+    r = await recorder.request(
+        client, "GET /login/{token}", "GET", httpx.URL(login_url).path, 307
+    )
+    if r is None or "vote_session" not in r.cookies:
+        return "login"
+    session_cookie = f"vote_session={r.cookies['vote_session']}"
+
+    r = await recorder.request(
+        client,
+        "GET /vote/{id}",
+        "GET",
+        f"/vote/{election_id}",
+        200,
+        headers={"cookie": session_cookie},
+    )
+    if r is None:
+        return "ballot"
+    csrf = csrf_from(r)
+    r = await recorder.request(
+        client,
+        "POST /vote/{id}",
+        "POST",
+        f"/vote/{election_id}",
+        303,
+        data={"csrf": csrf["form"], **ballot},
+        headers={"cookie": f"{session_cookie}; vote_csrf={csrf['cookie']}"},
+    )
+    if r is None:
+        return "vote"
+
+    await recorder.request(
+        client, "GET /", "GET", "/", 200, headers={"cookie": session_cookie}
+    )
+    return "voted"
+
+
+def load_ballot_options(url: str, election_id: int) -> Dict[int, List[int]]:
+    engine = sqlalchemy.create_engine(url)
+    with Session(engine) as session:
+        rows = session.execute(
+            sqlalchemy.select(QuestionOption.question_id, QuestionOption.id)
+            .join(Question)
+            .where(Question.election_id == election_id)
+        ).all()
+    engine.dispose()
+    options: Dict[int, List[int]] = collections.defaultdict(list)
+    for question_id, option_id in rows:
+        options[question_id].append(option_id)
+    return options
+
+
+def random_ballot(options: Dict[int, List[int]]) -> Dict[str, str]:
+    return {
+        f"question-{question_id}": str(random.choice(choices))
+        for question_id, choices in options.items()
+    }
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def run(args) -> Dict:
+    tmp = tempfile.TemporaryDirectory()
+    database_url = f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    election_id = setup_database(database_url, args)
+
+    directory = StubDirectory()
+    directory.start()
+    smtp = StubSMTP()
+    await smtp.start()
+
+    port = free_port()
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "CSRF_KEY": "benchmark",
+        "VOTE_ID_KEY": "benchmark vote ids",
+        "BASE_URL": f"http://127.0.0.1:{port}",
+        "DIRECTORY_URL": directory.url,
+        "SMTP_HOST": smtp.host,
+        "SMTP_PORT": str(smtp.port),
+        "SMTP_STARTTLS": "false",
+        "SMTP_USERNAME": "",
+        "SMTP_MAX_PER_SECOND": "0",
+        "MAILER_POLL_INTERVAL_S": "0.05",
+        "MAILER_METRICS_PORT": "0",
+        # Every simulated voter comes from the same address
+        "RATE_LIMIT_PATH": os.path.join(tmp.name, "ratelimit"),
+        "LOGIN_ADDRESS_BURST": str(args.voters * 2),
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "vote.serve:app",
+            "--workers",
+            str(args.workers),
+            "--worker-class",
+            "uvicorn.workers.UvicornWorker",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--log-level",
+            "warning",
+        ],
+        cwd=ROOT,
+        env=env,
+    )
+    mailer = subprocess.Popen(
+        [sys.executable, "-m", "vote", "mailer"], cwd=ROOT, env=env
+    )
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60
+    ) as client:
+        try:
+            # Wait for the workers to come up
+            for _ in range(300):
+                try:
+                    await client.get("/request_login")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Server did not start")
+
+            recorder = Recorder()
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            ballot_options = load_ballot_options(database_url, election_id)
+
+            async def voter(i: int) -> str:
+                async with semaphore:
+                    return await voter_journey(
+                        client,
+                        recorder,
+                        smtp,
+                        f"voter{i}",
+                        election_id,
+                        random_ballot(ballot_options),
+                        args,
+                    )
+
+            start = time.perf_counter()
+            outcomes = await asyncio.gather(*[voter(i) for i in range(args.voters)])
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            mailer.terminate()
+            server.wait()
+            mailer.wait()
+            await smtp.stop()
+            directory.stop()
+
+    accepted = outcomes.count("voted")
+    recorded = count_ballots(database_url, election_id)
+    tmp.cleanup()
+    requests = sum(len(v) for v in recorder.latencies.values())
+    return {
+        "voters": args.voters,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "questions": args.questions,
+        "options": args.options,
+        "past_elections": args.past_elections,
+        "seconds": elapsed,
+        "journeys_per_second": args.voters / elapsed,
+        "requests_per_second": requests / elapsed,
+        "ballots_accepted": accepted,
+        "ballots_recorded": recorded,
+        "ballots_lost": max(0, accepted - recorded),
+        "failed_journeys": dict(
+            collections.Counter(o for o in outcomes if o != "voted")
+        ),
+        "routes": {
+            route: {
+                "count": len(latencies),
+                "errors": recorder.errors[route],
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+            for route, latencies in recorder.latencies.items()
+        },
+    }
+
+
+def print_results(results: Dict):
+    print(
+        f"{results['voters']} voters, concurrency {results['concurrency']}, "
+        f"{results['workers']} workers, {results['questions']}x{results['options']} ballot"
+    )
+    print(
+        f"{results['seconds']:.2f}s: {results['journeys_per_second']:.1f} voters/s, "
+        f"{results['requests_per_second']:.1f} requests/s"
+    )
+    print(
+        f"{'route':<22}{'count':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    for route, r in results["routes"].items():
+        print(
+            f"{route:<22}{r['count']:>7}{r['errors']:>8}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+        )
+    print(
+        f"ballots accepted: {results['ballots_accepted']}, "
+        f"recorded: {results['ballots_recorded']}, lost: {results['ballots_lost']}"
+    )
+    if len(results["failed_journeys"]) > 0:
+        print(f"failed journeys by step: {results['failed_journeys']}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,126 @@
+"""
+Local stand-ins for the people directory and the SMTP relay, for load testing.
+"""
+import asyncio
+import email
+import email.policy
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+from typing import Dict, Optional
+
+
+class StubDirectory:
+    """HTTP server that reports every kerberos as a grad student"""
+
+    def __init__(self, host: str = "127.0.0.1"):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = urllib.parse.urlsplit(self.path).path
+                kerberos = urllib.parse.unquote(path.rsplit("/", 1)[-1])
+                body = json.dumps(
+                    {
+                        "result": [
+                            {
+                                "email_id": kerberos,
+                                "email_domain": "mit.edu",
+                                "student_year": "G",
+                            }
+                        ]
+                    }
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_port}/q/"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class StubSMTP:
+    """
+    Minimal SMTP sink (no TLS or AUTH) that keeps the login link sent to each kerberos.
+
+    Runs on the caller's event loop.
+    """
+
+    _login_url = re.compile(r"\S+/login/\S+")
+
+    def __init__(self, host: str = "127.0.0.1"):
+        self.host = host
+        self.port: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._login_urls: Dict[str, asyncio.Future] = {}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def wait_for_login_url(self, kerberos: str, timeout: float) -> Optional[str]:
+        try:
+            return await asyncio.wait_for(self._login_url_future(kerberos), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._login_urls.pop(kerberos, None)
+
+    def _login_url_future(self, kerberos: str) -> asyncio.Future:
+        if kerberos not in self._login_urls:
+            self._login_urls[kerberos] = asyncio.get_running_loop().create_future()
+        return self._login_urls[kerberos]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b"220 stub ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                command = line.decode("ascii", "replace").strip().upper()
+                if command.startswith("EHLO"):
+                    writer.write(b"250-stub\r\n250 8BITMIME\r\n")
+                elif command.startswith("DATA"):
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                    self._deliver(data[: -len(b".\r\n")].replace(b"\r\n..", b"\r\n."))
+                    writer.write(b"250 OK\r\n")
+                elif command.startswith("QUIT"):
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    # HELO, MAIL, RCPT, RSET and NOOP all succeed
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _deliver(self, data: bytes):
+        msg = email.message_from_bytes(data, policy=email.policy.default)
+        kerberos = msg["To"].addresses[0].username
+        match = self._login_url.search(msg.get_content())
+        if match is not None:
+            future = self._login_url_future(kerberos)
+            if not future.done():
+                future.set_result(match.group(0))
@@ -0,0 +1,40 @@
+"""
+Gunicorn server hooks. Gunicorn loads this file automatically when started from this directory.
+"""
+import os
+import shutil
+
+# Import the app once in the master, so that migrations, static file
+# compression and template compilation happen once rather than in every worker
+preload_app = True
+
+# Metrics files left by a previous run would be added to this run's totals.
+# This must happen before the app is imported, since vote.metrics opens its
+# files in the directory on import. Gunicorn reads this file again on reload,
+# when the running workers' files must be kept.
+_metrics_path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if _metrics_path is not None and os.environ.get("VOTE_METRICS_MASTER") != str(
+    os.getpid()
+):
+    shutil.rmtree(_metrics_path, ignore_errors=True)
+    os.makedirs(_metrics_path)
+    os.environ["VOTE_METRICS_MASTER"] = str(os.getpid())
+
+
+def on_starting(server):
+    from vote import serve
+
+    serve.preload()
+
+
+def post_fork(server, worker):
+    from vote import serve
+
+    serve.after_fork()
+
+
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,101 @@
+import datetime
+import os
+import re
+import tempfile
+
+# vote.config reads the settings once, on import, so they must be set before
+# any test imports the app
+_tmp = tempfile.mkdtemp(prefix="vote-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/elections.db"
+os.environ["RATE_LIMIT_PATH"] = f"{_tmp}/ratelimit"
+os.environ["CSRF_KEY"] = "test"
+os.environ["VOTE_ID_KEY"] = "test vote ids"
+os.environ["QUERY_TRACE_HEADER"] = "true"
+
+import pytest
+from sqlalchemy.orm import Session
+
+from vote.cache import STRUCTURE, bump_versions
+from vote.models import *
+
+
+@pytest.fixture(scope="session")
+def serve():
+    from vote import serve
+
+    return serve
+
+
+@pytest.fixture
+def client(serve):
+    from fastapi.testclient import TestClient
+
+    with TestClient(serve.app, base_url="https://testserver") as client:
+        yield client
+
+
+@pytest.fixture
+def make_election(serve):
+    """Creates an open, visible election with the given questions ({name: [options]})"""
+
+    def make(questions, name="Election"):
+        now = datetime.datetime.now()
+        with Session(serve.db_engine) as session:
+            election = Election(
+                name=name,
+                visible=True,
+                open_timestamp=now - datetime.timedelta(days=1),
+                close_timestamp=now + datetime.timedelta(days=1),
+                questions=[
+                    Question(
+                        name=question,
+                        options=[QuestionOption(name=o) for o in options],
+                    )
+                    for question, options in questions.items()
+                ],
+            )
+            session.add(election)
+            bump_versions(session, STRUCTURE)
+            session.commit()
+            return {
+                "id": election.id,
+                "questions": {
+                    q.name: {"id": q.id, "options": [o.id for o in q.options]}
+                    for q in election.questions
+                },
+            }
+
+    return make
+
+
+@pytest.fixture
+def login(serve, client):
+    """Logs the client in as kerberos with a new browser session"""
+
+    def login(kerberos):
+        with Session(serve.db_engine) as session:
+            session.add(
+                BrowserSession(
+                    kerberos=kerberos,
+                    cookie=f"cookie-{kerberos}",
+                    expiration=datetime.datetime.now() + datetime.timedelta(hours=1),
+                )
+            )
+            session.commit()
+        client.cookies.clear()
+        client.cookies.set("vote_session", f"cookie-{kerberos}")
+
+    return login
+
+
+@pytest.fixture
+def ballot_form(client):
+    """Loads a ballot page and returns the form fields needed to submit it"""
+
+    def ballot_form(election_id):
+        r = client.get(f"/vote/{election_id}")
+        csrf = re.search(r'name="csrf" value="([^"]+)"', r.text).group(1)
+        client.cookies.set("vote_csrf", r.cookies.get("vote_csrf"))
+        return {"csrf": csrf}
+
+    return ballot_form
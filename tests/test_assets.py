@@ -0,0 +1,27 @@
+import pytest
+
+
+def get(client, encoding, **headers):
+    return client.get(
+        "/static/bootstrap.min.css", headers={"Accept-Encoding": encoding, **headers}
+    )
+
+
+def test_etag_differs_by_encoding(client):
+    etags = {
+        encoding: get(client, encoding).headers["etag"]
+        for encoding in ("br", "gzip", "identity")
+    }
+    assert len(set(etags.values())) == 3
+    assert etags["br"].endswith('-br"')
+    assert etags["gzip"].endswith('-gz"')
+
+
+@pytest.mark.parametrize("encoding", ["br", "gzip", "identity"])
+def test_not_modified_only_for_same_encoding(client, encoding):
+    etag = get(client, encoding).headers["etag"]
+    assert get(client, encoding, **{"If-None-Match": etag}).status_code == 304
+    other = "identity" if encoding != "identity" else "gzip"
+    r = get(client, other, **{"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["etag"] != etag
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from vote.manifest import apply_manifest, read_manifest
+from vote.models import *
+from vote.snapshots import finalize_elections, load_snapshots
+
+MANIFEST = """
+name: {name}
+open: 2020-01-01 09:00
+close: 2020-01-02 17:00
+visible: {visible}
+questions:
+  - name: Should the contract be ratified?
+    options: [Yes, No]
+"""
+
+
+def read(name="Ratification", visible="no"):
+    f = io.StringIO(MANIFEST.format(name=name, visible=visible))
+    f.name = "manifest.yaml"
+    return read_manifest(f)
+
+
+@pytest.fixture
+def session():
+    engine = sqlalchemy.create_engine("sqlite://")
+    OrmBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.mark.parametrize(
+    "visible,expected", [("no", False), ("Off", False), ("yes", True), ("true", True)]
+)
+def test_visible_is_a_bool(session, visible, expected):
+    election_id, _ = apply_manifest(session, read(visible=visible))
+    assert session.get(Election, election_id).visible is expected
+
+
+def test_visible_must_be_a_bool():
+    with pytest.raises(ValueError, match="visible"):
+        read(visible="maybe")
+
+
+def test_rename_discards_snapshot(session):
+    election_id, _ = apply_manifest(session, read())
+    finalize_elections(session, [election_id])
+    assert "Ratification" in load_snapshots(session)[election_id]["html"]
+
+    manifest = read(name="Contract ratification")
+    manifest["id"] = election_id
+    _, changes = apply_manifest(session, manifest)
+    assert changes == ["set name to Contract ratification"]
+    assert election_id not in load_snapshots(session)
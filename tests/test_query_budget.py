@@ -0,0 +1,55 @@
+"""
+Query budgets for the pages served during an election.
+
+Each page is requested with elections of different sizes, so that a query
+per election, question or option (an N+1 regression) breaks the budget.
+"""
+import pytest
+
+from vote.profiling import assert_max_queries
+
+
+def make_elections(make_election, count, questions):
+    return [
+        make_election(
+            {f"Question {q}": ["A", "B", "C", "D"] for q in range(questions)},
+            name=f"Election {e}",
+        )
+        for e in range(count)
+    ]
+
+
+@pytest.mark.parametrize("elections,questions", [(1, 1), (4, 6)])
+def test_homepage(client, make_election, login, elections, questions):
+    make_elections(make_election, elections, questions)
+    login("alice")
+    # Loading the elections, ballots and tallies after they changed
+    r = assert_max_queries(client, 6, "GET", "/")
+    assert r.status_code == 200
+    # Then only the session and the cache versions
+    assert_max_queries(client, 2, "GET", "/")
+
+
+@pytest.mark.parametrize("elections,questions", [(1, 1), (4, 6)])
+def test_ballot_page(client, make_election, login, elections, questions):
+    election = make_elections(make_election, elections, questions)[-1]
+    login("bob")
+    client.get("/")
+    r = assert_max_queries(client, 2, "GET", f"/vote/{election['id']}")
+    assert 'name="csrf"' in r.text
+
+
+@pytest.mark.parametrize("elections,questions", [(1, 1), (4, 6)])
+def test_submit_ballot(client, make_election, login, ballot_form, elections, questions):
+    election = make_elections(make_election, elections, questions)[-1]
+    login(f"carol{elections}")
+    form = ballot_form(election["id"])
+    for question in election["questions"].values():
+        form[f"question-{question['id']}"] = str(question["options"][0])
+    # The ballot itself is written by the writer thread, outside the request
+    r = assert_max_queries(
+        client, 1, "POST", f"/vote/{election['id']}", data=form, follow_redirects=False
+    )
+    assert r.status_code == 303
+    r = client.get(f"/vote/{election['id']}")
+    assert 'name="csrf"' not in r.text
@@ -0,0 +1,152 @@
+import numpy
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from vote.models import *
+from vote.ranked import (
+    count_question,
+    count_ranked,
+    load_ranking_matrix,
+    pack_ranking,
+    unpack_ranking,
+)
+
+
+def matrix(*groups):
+    """Builds a ranking matrix from (count, ranking) pairs, padding short rankings"""
+    rows = [ranking for count, ranking in groups for _ in range(count)]
+    width = max(len(ranking) for ranking in rows)
+    candidates = max(c for ranking in rows for c in ranking) + 1
+    return numpy.array(
+        [ranking + [candidates] * (width - len(ranking)) for ranking in rows],
+        dtype=numpy.int32,
+    )
+
+
+@pytest.fixture
+def session():
+    engine = sqlalchemy.create_engine("sqlite://")
+    OrmBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_irv_majority_after_eliminations():
+    memphis, nashville, chattanooga, knoxville = range(4)
+    result = count_ranked(
+        matrix(
+            (42, [memphis, nashville, chattanooga, knoxville]),
+            (26, [nashville, chattanooga, knoxville, memphis]),
+            (15, [chattanooga, knoxville, nashville, memphis]),
+            (17, [knoxville, chattanooga, nashville, memphis]),
+        ),
+        4,
+        majority=True,
+    )
+    assert result["winners"] == [knoxville]
+    assert [r["eliminated"] for r in result["rounds"]] == [
+        [chattanooga],
+        [nashville],
+        [],
+    ]
+    assert result["rounds"][1]["votes"] == {memphis: 42, nashville: 26, knoxville: 32}
+    assert result["rounds"][2]["votes"] == {memphis: 42, knoxville: 58}
+    assert [r["quota"] for r in result["rounds"]] == [51, 51, 51]
+
+
+def test_stv_transfers_surplus():
+    a, b, c = range(3)
+    # 12 ballots for 2 seats: the Droop quota is 5
+    result = count_ranked(
+        matrix((6, [a, b]), (1, [a, c]), (2, [b]), (3, [c])), 3, seats=2
+    )
+    assert result["winners"] == [a, b]
+    first, second, third = result["rounds"]
+    assert first["quota"] == 5
+    assert first["elected"] == [a]
+    # a's 2 surplus votes move on at 2/7 of each of a's 7 ballots
+    assert second["votes"][b] == pytest.approx(2 + 6 * 2 / 7)
+    assert second["votes"][c] == pytest.approx(3 + 2 / 7)
+    assert second["eliminated"] == [c]
+    # Without the transfer, c would have beaten b
+    assert third["elected"] == [b]
+    assert third["exhausted"] == pytest.approx(3 + 2 / 7)
+
+
+def test_stv_elects_several_in_one_round():
+    a, b, c, d = range(4)
+    # 20 ballots for 3 seats: the Droop quota is 6
+    result = count_ranked(
+        matrix((7, [a, d]), (6, [b, d]), (3, [c]), (4, [d])), 4, seats=3
+    )
+    first = result["rounds"][0]
+    assert first["elected"] == [a, b]
+    assert result["rounds"][1]["votes"][d] == pytest.approx(4 + 1)
+    assert result["winners"] == [a, b, d]
+
+
+def test_tie_broken_by_earlier_round():
+    a, b, c, d = range(4)
+    result = count_ranked(
+        matrix((5, [a]), (3, [b]), (4, [c]), (1, [d, b])), 4, majority=True
+    )
+    # b and c both have 4 votes in the second round, but b had fewer in the first
+    assert result["rounds"][1]["votes"] == {a: 5, b: 4, c: 4}
+    assert result["rounds"][1]["eliminated"] == [b]
+    assert result["winners"] == [a]
+
+
+def test_tie_broken_by_listing_order():
+    a, b, c = range(3)
+    result = count_ranked(matrix((2, [a]), (1, [b]), (1, [c])), 3, majority=True)
+    assert result["rounds"][0]["eliminated"] == [b]
+    assert result["winners"] == [a]
+
+
+def test_exhausted_ballots():
+    a, b, c = range(3)
+    result = count_ranked(
+        matrix((3, [a]), (3, [b]), (1, [c]), (1, [c, b])), 3, majority=True
+    )
+    assert result["rounds"][0]["eliminated"] == [c]
+    assert [r["exhausted"] for r in result["rounds"]] == [0, 1]
+    # b wins with a majority of the 7 ballots still counting, not of all 8
+    assert result["rounds"][1]["quota"] == 4
+    assert result["rounds"][1]["votes"] == {a: 3, b: 4}
+    assert result["winners"] == [b]
+
+
+def test_zero_ballots(session):
+    assert count_ranked(numpy.zeros((0, 0), dtype=numpy.int32), 3) == {
+        "winners": [],
+        "rounds": [],
+    }
+    assert load_ranking_matrix(session, 1, [1, 2]).shape == (0, 0)
+    result = count_question(
+        session,
+        {"id": 1, "method": "irv", "seats": 1, "options": [{"id": 1, "name": "A"}]},
+    )
+    assert result["ballots"] == 0
+    assert result["winners"] == []
+
+
+def test_load_ranking_matrix(session):
+    assert unpack_ranking(pack_ranking([30, 10])) == [30, 10]
+    session.add_all(
+        [
+            RankedBallot(id=1, question_id=7, ranking=pack_ranking([30, 10, 20])),
+            RankedBallot(id=2, question_id=7, ranking=pack_ranking([20])),
+            RankedBallot(id=3, question_id=8, ranking=pack_ranking([40])),
+        ]
+    )
+    session.flush()
+    loaded = load_ranking_matrix(session, 7, [10, 20, 30])
+    assert sorted(loaded.tolist()) == [[1, 3, 3], [2, 0, 1]]
+
+
+def test_ballot_ranking_another_option(session):
+    session.add(RankedBallot(id=1, question_id=7, ranking=pack_ranking([10, 99])))
+    session.flush()
+    with pytest.raises(ValueError, match="another option"):
+        load_ranking_matrix(session, 7, [10, 20])
@@ -0,0 +1,17 @@
+def test_election_removed_while_voting(
+    serve, client, make_election, login, ballot_form, monkeypatch
+):
+    election = make_election({"Question": ["Yes", "No"]}, name="Removed")
+    login("dana")
+    form = ballot_form(election["id"])
+    question = election["questions"]["Question"]
+    form[f"question-{question['id']}"] = str(question["options"][0])
+
+    # The ballots are reloaded after a structure change that dropped the election
+    async def no_ballots(session):
+        return {}
+
+    monkeypatch.setattr(serve, "get_compiled_ballots", no_ballots)
+    r = client.post(f"/vote/{election['id']}", data=form, follow_redirects=False)
+    assert r.status_code == 303
+    assert r.headers["location"] == f"/vote/{election['id']}"
@@ -0,0 +1,59 @@
+import datetime
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from vote.cache import STRUCTURE, bump_versions
+from vote.models import *
+from vote.snapshots import finalize_elections
+from vote.writer import BallotResult
+
+
+def close_election(serve, election_id):
+    with Session(serve.db_engine) as session:
+        election = session.get(Election, election_id)
+        election.close_timestamp = datetime.datetime.now() - datetime.timedelta(
+            seconds=1
+        )
+        bump_versions(session, STRUCTURE)
+        session.commit()
+
+
+def test_ballot_after_finalization_is_rejected(serve, client, make_election):
+    election = make_election({"Question": ["Yes", "No"]}, name="Finalized")
+    yes, no = election["questions"]["Question"]["options"]
+    submit = serve.ballot_writer.submit
+    assert submit("early", election["id"], [yes]).result() == BallotResult.ACCEPTED
+
+    close_election(serve, election["id"])
+    with Session(serve.db_engine) as session:
+        finalize_elections(session, [election["id"]])
+        session.commit()
+    # Accepted before the close, but committed after the results were frozen
+    assert submit("late", election["id"], [no]).result() == BallotResult.CLOSED
+
+    results = client.get(f"/elections/{election['id']}/results").json()
+    assert results["final"] is True
+    assert results["total_votes"] == 1
+    assert [o["votes"] for o in results["questions"][0]["options"]] == [1, 0]
+    with Session(serve.db_engine) as session:
+        stored = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count(Voter.kerberos)).where(
+                Voter.election_id == election["id"]
+            )
+        )
+    assert stored == 1
+
+
+def test_ballot_just_after_close_is_counted(serve, client, make_election):
+    election = make_election({"Question": ["Yes", "No"]}, name="Just closed")
+    yes, no = election["questions"]["Question"]["options"]
+    close_election(serve, election["id"])
+    # Still within FINALIZE_DELAY, and not finalized yet
+    result = serve.ballot_writer.submit("last", election["id"], [no]).result()
+    assert result == BallotResult.ACCEPTED
+    with Session(serve.db_engine) as session:
+        finalize_elections(session, [election["id"]])
+        session.commit()
+    results = client.get(f"/elections/{election['id']}/results").json()
+    assert [o["votes"] for o in results["questions"][0]["options"]] == [0, 1]
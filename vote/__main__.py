@@ -2,11 +2,30 @@
 CLI interface to add/remove elections and votes.
 """
 import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import sys
 
+import prometheus_client
 import sqlalchemy
 from sqlalchemy.orm import Session
 
+from .cache import STRUCTURE, bump_versions
+from .config import settings
+from .database import create_engine
+from .directory import DirectoryClient
+from .eligibility import import_roster, read_roster, refresh_eligibility
+from .export import FORMATS, export_votes, write_results
+from .mailer import Mailer
+from .manifest import apply_manifest, read_manifest
+from .migrations import migrate
 from .models import *
+from .outbox import run_mailer
+from .ranked import count_question
+from .retention import enable_incremental_vacuum, run_retention
+from .snapshots import discard_snapshot, finalize_elections
 
 parser = argparse.ArgumentParser(prog="vote CLI")
 subparsers = parser.add_subparsers(
@@ -36,6 +55,41 @@ toggle_election_parser.add_argument("id", type=int)
 remove_election_parser = election_subparsers.add_parser("remove")
 remove_election_parser.add_argument("id", type=int)
 list_election_parser = election_subparsers.add_parser("list")
+results_election_parser = election_subparsers.add_parser(
+    "results", help="count the votes for each option"
+)
+results_election_parser.add_argument("id", type=int)
+results_election_parser.add_argument("--format", choices=FORMATS, default="csv")
+results_election_parser.add_argument(
+    "--output", default="-", help="file to write to (default: standard output)"
+)
+export_election_parser = election_subparsers.add_parser(
+    "export", help="write out every stored vote, one row per selected option"
+)
+export_election_parser.add_argument("id", type=int)
+export_election_parser.add_argument(
+    "--format", choices=FORMATS, default="csv", help="json writes one object per line"
+)
+export_election_parser.add_argument(
+    "--output", default="-", help="file to write to (default: standard output)"
+)
+export_election_parser.add_argument("--batch-size", type=int, default=10000)
+load_election_parser = election_subparsers.add_parser(
+    "load", help="create or update an election from a YAML or JSON manifest"
+)
+load_election_parser.add_argument("manifest", type=argparse.FileType("r"))
+load_election_parser.add_argument(
+    "--dry-run", action="store_true", help="show the changes without saving them"
+)
+finalize_election_parser = election_subparsers.add_parser(
+    "finalize", help="count a closed election's votes and freeze its results"
+)
+finalize_election_parser.add_argument("id", type=int)
+tally_election_parser = election_subparsers.add_parser(
+    "tally", help="count the ranked questions round by round"
+)
+tally_election_parser.add_argument("id", type=int)
+tally_election_parser.add_argument("--format", choices=["text", "json"], default="text")
 
 question_parser = subparsers.add_parser("question", help="question help")
 question_subparsers = question_parser.add_subparsers(
@@ -45,25 +99,85 @@ add_question_parser = question_subparsers.add_parser("add")
 add_question_parser.add_argument("election_id")
 add_question_parser.add_argument("name")
 add_question_parser.add_argument("options", nargs="+")
+add_question_parser.add_argument(
+    "--method",
+    choices=QUESTION_METHODS,
+    default="plurality",
+    help="irv and stv questions are answered by ranking the options",
+)
+add_question_parser.add_argument(
+    "--seats", type=int, default=1, help="number of winners of an stv question"
+)
 remove_question_parser = question_subparsers.add_parser("remove")
 remove_question_parser.add_argument("id", type=int)
 
+eligibility_parser = subparsers.add_parser("eligibility", help="eligibility help")
+eligibility_subparsers = eligibility_parser.add_subparsers(
+    required=True, dest="subparser_command"
+)
+import_eligibility_parser = eligibility_subparsers.add_parser(
+    "import", help="mark every kerberos in a CSV roster as eligible"
+)
+import_eligibility_parser.add_argument("roster", type=argparse.FileType("r"))
+import_eligibility_parser.add_argument("--column", default="kerberos")
+import_eligibility_parser.add_argument("--batch-size", type=int, default=5000)
+refresh_eligibility_parser = eligibility_subparsers.add_parser(
+    "refresh", help="re-check cached eligibility against the directory"
+)
+refresh_eligibility_parser.add_argument(
+    "--older-than-days",
+    type=float,
+    default=0,
+    help="only re-check entries last confirmed at least this long ago",
+)
+refresh_eligibility_parser.add_argument("--concurrency", type=int, default=20)
+refresh_eligibility_parser.add_argument("--batch-size", type=int, default=500)
+
+mailer_parser = subparsers.add_parser(
+    "mailer", help="send queued login emails (run as a service)"
+)
+mailer_parser.add_argument(
+    "--once", action="store_true", help="exit once no emails are due"
+)
+retention_parser = subparsers.add_parser(
+    "retention",
+    help="delete expired sessions and login tokens and compact the database",
+)
+retention_parser.add_argument(
+    "--vacuum-pages",
+    type=int,
+    default=500,
+    help="free pages released per write transaction",
+)
+retention_parser.add_argument(
+    "--enable-incremental-vacuum",
+    action="store_true",
+    help="convert a database created before incremental vacuum was used; "
+    "this rewrites the whole file and blocks voting while it runs",
+)
+
 args = parser.parse_args()
 
 # Setup database
-db_engine = sqlalchemy.create_engine("sqlite:////var/lib/vote-daemon/elections.db")
-OrmBase.metadata.create_all(db_engine)
+db_engine = create_engine(settings)
+migrate(db_engine)
 
 if args.subparser_category == "election":
     if args.subparser_command == "list":
         with Session(db_engine) as session:
-            stmt = sqlalchemy.select(Election)
+            stmt = sqlalchemy.select(Election).options(
+                sqlalchemy.orm.selectinload(Election.questions).selectinload(
+                    Question.options
+                )
+            )
             for election in session.scalars(stmt):
                 print(
                     f"{election.name}\n\tid: {election.id}\n\tvisible: {election.visible}\n\topen: {election.open_timestamp}\n\tclose: {election.close_timestamp}"
                 )
                 for question in election.questions:
-                    print(f"\tquestion: {question.name} (id: {question.id})")
+                    print(
+                        f"\tquestion: {question.name} (id: {question.id}, method: {question.method})"
+                    )
                     for option in question.options:
                         print(f"\t\t- {option.name}")
     elif args.subparser_command == "add":
@@ -75,6 +189,7 @@ if args.subparser_category == "election":
                 close_timestamp=args.close_datetime,
             )
             session.add(election)
+            bump_versions(session, STRUCTURE)
             session.commit()
     elif args.subparser_command == "toggle":
         with Session(db_engine) as session:
@@ -83,6 +198,7 @@ if args.subparser_category == "election":
             if election is None:
                 raise ValueError("Invalid election ID")
             election.visible = not election.visible
+            bump_versions(session, STRUCTURE)
             session.commit()
     elif args.subparser_command == "open_time":
         with Session(db_engine) as session:
@@ -91,6 +207,7 @@ if args.subparser_category == "election":
             if election is None:
                 raise ValueError("Invalid election ID")
             election.open_timestamp = args.open_datetime
+            bump_versions(session, STRUCTURE)
             session.commit()
     elif args.subparser_command == "close_time":
         with Session(db_engine) as session:
@@ -99,6 +216,8 @@ if args.subparser_category == "election":
             if election is None:
                 raise ValueError("Invalid election ID")
             election.close_timestamp = args.close_datetime
+            discard_snapshot(session, election.id)
+            bump_versions(session, STRUCTURE)
             session.commit()
     elif args.subparser_command == "remove":
         with Session(db_engine) as session:
@@ -106,24 +225,218 @@ if args.subparser_category == "election":
             election = session.scalar(stmt)
             if election is None:
                 raise ValueError("Invalid election ID")
+            discard_snapshot(session, election.id)
             session.delete(election)
+            bump_versions(session, STRUCTURE)
+            session.commit()
+    elif args.subparser_command == "load":
+        with args.manifest:
+            manifest = read_manifest(args.manifest)
+        with Session(db_engine) as session:
+            election_id, changes = apply_manifest(session, manifest)
+            if args.dry_run:
+                session.rollback()
+            else:
+                session.commit()
+        if len(changes) == 0:
+            print(f"Election {election_id} is up to date")
+        else:
+            verb = "Would change" if args.dry_run else "Changed"
+            print(f"{verb} election {election_id}: {', '.join(changes)}")
+    elif args.subparser_command in ("results", "export"):
+        binary = args.format == "parquet"
+        if args.output == "-":
+            output = contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+        else:
+            output = open(
+                args.output, "wb" if binary else "w", newline=None if binary else ""
+            )
+        with output as f, db_engine.connect() as connection:
+            if args.subparser_command == "results":
+                write_results(connection, args.id, args.format, f)
+            else:
+                count = export_votes(
+                    connection, args.id, args.format, f, batch_size=args.batch_size
+                )
+                print(f"Exported {count} votes", file=sys.stderr)
+    elif args.subparser_command == "finalize":
+        with Session(db_engine) as session:
+            stmt = sqlalchemy.select(Election).where(Election.id == args.id)
+            if session.scalar(stmt) is None:
+                raise ValueError("Invalid election ID")
+            finalize_elections(session, [args.id])
             session.commit()
+    elif args.subparser_command == "tally":
+        with Session(db_engine) as session:
+            stmt = (
+                sqlalchemy.select(Election)
+                .where(Election.id == args.id)
+                .options(
+                    sqlalchemy.orm.selectinload(Election.questions).selectinload(
+                        Question.options
+                    )
+                )
+            )
+            election = session.scalar(stmt)
+            if election is None:
+                raise ValueError("Invalid election ID")
+            counts = [
+                {
+                    "question_id": question.id,
+                    "question": question.name,
+                    **count_question(
+                        session,
+                        {
+                            "id": question.id,
+                            "method": question.method,
+                            "seats": question.seats,
+                            "options": [
+                                {"id": option.id, "name": option.name}
+                                for option in question.options
+                            ],
+                        },
+                    ),
+                }
+                for question in election.questions
+                if question.method != "plurality"
+            ]
+        if len(counts) == 0:
+            print(f"Election {args.id} has no ranked questions", file=sys.stderr)
+        elif args.format == "json":
+            print(json.dumps(counts, indent=2))
+        else:
+            for count in counts:
+                print(
+                    f"{count['question']} ({count['method']}, {count['seats']} seats, {count['ballots']} ballots)"
+                )
+                for number, r in enumerate(count["rounds"], 1):
+                    votes = ", ".join(f"{o['name']} {o['votes']}" for o in r["votes"])
+                    print(f"\tround {number}, quota {r['quota']}: {votes}")
+                    print(f"\t\texhausted: {r['exhausted']}")
+                    for key in ("elected", "eliminated"):
+                        if len(r[key]) > 0:
+                            print(f"\t\t{key}: {', '.join(o['name'] for o in r[key])}")
+                winners = ", ".join(o["name"] for o in count["winners"])
+                print(f"\twinners: {winners or 'none'}")
 elif args.subparser_category == "question":
     if args.subparser_command == "add":
         with Session(db_engine) as session:
+            if args.seats < 1 or (args.method != "stv" and args.seats != 1):
+                raise ValueError("Only stv questions can have more than one seat")
             question = Question(
                 name=args.name,
                 election_id=args.election_id,
+                method=args.method,
+                seats=args.seats,
             )
             for option in args.options:
                 question.options.append(QuestionOption(name=option))
             session.add(question)
+            discard_snapshot(session, question.election_id)
+            bump_versions(session, STRUCTURE)
             session.commit()
-    elif args.subparser_comand == "remove":
+    elif args.subparser_command == "remove":
         with Session(db_engine) as session:
             stmt = sqlalchemy.select(Question).where(Question.id == args.id)
             question = session.scalar(stmt)
             if question is None:
                 raise ValueError("Invalid election ID")
+            discard_snapshot(session, question.election_id)
             session.delete(question)
+            bump_versions(session, STRUCTURE)
             session.commit()
+elif args.subparser_category == "eligibility":
+    if args.subparser_command == "import":
+        with args.roster:
+            count = import_roster(
+                db_engine, read_roster(args.roster, args.column), args.batch_size
+            )
+        print(f"Imported {count} kerberos names")
+    elif args.subparser_command == "refresh":
+        client = DirectoryClient(
+            settings.directory_url,
+            timeout=settings.directory_timeout_s,
+            negative_ttl=0,
+            max_connections=args.concurrency,
+        )
+
+        async def refresh():
+            try:
+                return await refresh_eligibility(
+                    db_engine,
+                    client,
+                    datetime.datetime.now()
+                    - datetime.timedelta(days=args.older_than_days),
+                    concurrency=args.concurrency,
+                    batch_size=args.batch_size,
+                )
+            finally:
+                await client.close()
+
+        counts = asyncio.run(refresh())
+        print(
+            f"Still eligible: {counts['eligible']}, removed: {counts['removed']}, lookup failed: {counts['failed']}"
+        )
+elif args.subparser_category == "mailer":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    # Every directory lookup would otherwise be logged
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # Directory and SMTP latency are only observed here, not in the web workers
+    if settings.mailer_metrics_port != 0 and not args.once:
+        prometheus_client.start_http_server(
+            settings.mailer_metrics_port, addr=settings.mailer_metrics_address
+        )
+    mailer = Mailer(
+        settings.smtp_host,
+        settings.smtp_port,
+        username=settings.smtp_username,
+        password=settings.smtp_password,
+        starttls=settings.smtp_starttls,
+        pool_size=settings.smtp_pool_size,
+        max_per_second=settings.smtp_max_per_second,
+    )
+    client = DirectoryClient(
+        settings.directory_url,
+        timeout=settings.directory_timeout_s,
+        negative_ttl=settings.directory_negative_ttl_s,
+        max_connections=settings.directory_max_connections,
+    )
+
+    async def dispatch():
+        try:
+            await run_mailer(
+                db_engine,
+                mailer,
+                client,
+                settings.base_url,
+                poll_interval=settings.mailer_poll_interval_s,
+                once=args.once,
+                batch_size=settings.mailer_batch_size,
+                max_attempts=settings.mailer_max_attempts,
+                retry_base=datetime.timedelta(seconds=settings.mailer_retry_base_s),
+            )
+        finally:
+            await client.close()
+            mailer.close()
+
+    try:
+        asyncio.run(dispatch())
+    except KeyboardInterrupt:
+        pass
+elif args.subparser_category == "retention":
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(db_engine)
+    counts = run_retention(
+        db_engine,
+        datetime.datetime.now()
+        - datetime.timedelta(hours=settings.retention_grace_hours),
+        batch_size=settings.retention_batch_size,
+        vacuum_pages=args.vacuum_pages,
+    )
+    print(
+        f"Deleted {counts['sessions']} sessions, {counts['login_tokens']} login tokens "
+        f"and {counts['outbox_emails']} unsent emails; released {counts['pages_released']} "
+        f"pages and checkpointed {counts['pages_checkpointed']}"
+    )
@@ -0,0 +1,143 @@
+"""
+Serves static files under content-hashed names, precompressed with gzip and brotli.
+
+At startup every file in the directory is read into memory, fingerprinted
+and compressed once. Templates link to assets with static_url(name), which
+returns the fingerprinted path (e.g. /static/bootstrap.min.3f2a9c1e04b7.css).
+Fingerprinted paths never change content, so they are served with an
+immutable Cache-Control. The original names are still served, but must be
+revalidated.
+"""
+import dataclasses
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict
+
+import brotli
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Each encoding is a different representation, so needs its own strong ETag
+_ETAG_SUFFIXES = {"identity": "", "br": "-br", "gzip": "-gz"}
+
+
+@dataclasses.dataclass
+class Asset:
+    content_type: str
+    content_hash: str
+    # Content-Encoding ("identity", "br" or "gzip") -> body
+    encodings: Dict[str, bytes]
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.content_hash}{_ETAG_SUFFIXES[encoding]}"'
+
+
+class StaticAssets:
+    """ASGI app serving the files in a directory, to be mounted at prefix"""
+
+    def __init__(self, directory: str, prefix: str = "/static"):
+        self.prefix = prefix
+        self._assets: Dict[str, Asset] = {}
+        self._fingerprinted: Dict[str, str] = {}
+        digest = hashlib.sha256()
+        for root, _, files in os.walk(directory):
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    content = f.read()
+                file_hash = hashlib.sha256(content).hexdigest()[:12]
+                stem, ext = os.path.splitext(name)
+                fingerprinted = f"{stem}.{file_hash}{ext}"
+                asset = Asset(
+                    content_type=mimetypes.guess_type(name)[0]
+                    or "application/octet-stream",
+                    content_hash=file_hash,
+                    encodings=self._compress(content),
+                )
+                self._assets[name] = asset
+                self._assets[fingerprinted] = asset
+                self._fingerprinted[name] = fingerprinted
+                digest.update(f"{fingerprinted}\n".encode("utf-8"))
+        # Changes whenever any asset does, for the ETags of pages linking to them
+        self.digest = digest.hexdigest()
+
+    def url(self, name: str) -> str:
+        """Returns the fingerprinted URL of a file in the directory"""
+        if name not in self._fingerprinted:
+            raise ValueError(f"Unknown static file {name}")
+        return f"{self.prefix}/{self._fingerprinted[name]}"
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        response = self._respond(scope)
+        await response(scope, receive, send)
+
+    def _respond(self, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            return PlainTextResponse(
+                "Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"}
+            )
+        # Mount passes the path below the prefix
+        name = scope["path"].lstrip("/")
+        asset = self._assets.get(name)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        request_headers = Headers(scope=scope)
+        is_original_name = name in self._fingerprinted
+        encoding = self._choose_encoding(
+            request_headers.get("accept-encoding", ""), asset
+        )
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache" if is_original_name else IMMUTABLE,
+        }
+        if_none_match = request_headers.get("if-none-match", "")
+        if etag in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        body = asset.encodings[encoding]
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, headers=headers, media_type=asset.content_type)
+
+    @staticmethod
+    def _compress(content: bytes) -> Dict[str, bytes]:
+        encodings = {"identity": content}
+        for encoding, compressed in (
+            ("br", brotli.compress(content, quality=11)),
+            ("gzip", gzip.compress(content, compresslevel=9, mtime=0)),
+        ):
+            # Small files can come out larger
+            if len(compressed) < len(content):
+                encodings[encoding] = compressed
+        return encodings
+
+    @staticmethod
+    def _choose_encoding(accept_encoding: str, asset: Asset) -> str:
+        accepted = set()
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            name, _, value = params.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    if float(value) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in asset.encodings and (
+                encoding in accepted or "*" in accepted
+            ):
+                return encoding
+        return "identity"
@@ -0,0 +1,96 @@
+"""
+Immutable per-election ballot structures, so submitted votes can be validated in memory.
+"""
+import dataclasses
+import types
+from typing import Dict, FrozenSet, List, Mapping
+
+
+@dataclasses.dataclass(frozen=True)
+class SubmittedBallot:
+    # The chosen option of each plurality question
+    option_ids: List[int]
+    # The options of each ranked question, most preferred first
+    rankings: Dict[int, List[int]]
+
+
+@dataclasses.dataclass(frozen=True)
+class CompiledBallot:
+    election_id: int
+    # Every question that must be answered
+    question_ids: FrozenSet[int]
+    # The questions answered by ranking their options
+    ranked_question_ids: FrozenSet[int]
+    # Maps each option in this election to its question
+    option_questions: Mapping[int, int]
+
+    @classmethod
+    def compile(cls, election: Dict) -> "CompiledBallot":
+        """Builds the ballot from a cached election structure"""
+        return cls(
+            election_id=election["id"],
+            question_ids=frozenset(q["id"] for q in election["questions"]),
+            ranked_question_ids=frozenset(
+                q["id"] for q in election["questions"] if q["method"] != "plurality"
+            ),
+            option_questions=types.MappingProxyType(
+                {o["id"]: q["id"] for q in election["questions"] for o in q["options"]}
+            ),
+        )
+
+    def validate(self, votes: Dict[str, str]) -> SubmittedBallot:
+        """
+        Checks a submitted ballot form.
+
+        Plurality questions are answered with question-{question id} = option id,
+        and ranked questions with rank-{question id}-{option id} = 1, 2, ...
+        for as many options as the voter wants to rank (blank for the rest).
+        """
+        submitted_questions = set()
+        submitted_options = []
+        ranks: Dict[int, Dict[int, int]] = {}
+        for k, v in votes.items():
+            if k.startswith("question-"):
+                try:
+                    vote_question = int(k[9:])
+                    vote = int(v)
+                except ValueError:
+                    raise RuntimeError("Malformed vote")
+                # Validate that the vote is actually for this question and this election
+                question_id = self.option_questions.get(vote)
+                if question_id is None:
+                    raise RuntimeError("Invalid option for this election")
+                if (
+                    question_id != vote_question
+                    or question_id in self.ranked_question_ids
+                ):
+                    raise RuntimeError("Invalid question for this option")
+                submitted_questions.add(vote_question)
+                submitted_options.append(vote)
+            elif k.startswith("rank-"):
+                if v == "":
+                    continue
+                try:
+                    vote_question, vote = (int(part) for part in k[5:].split("-"))
+                    rank = int(v)
+                except ValueError:
+                    raise RuntimeError("Malformed vote")
+                question_id = self.option_questions.get(vote)
+                if question_id is None:
+                    raise RuntimeError("Invalid option for this election")
+                if (
+                    question_id != vote_question
+                    or question_id not in self.ranked_question_ids
+                ):
+                    raise RuntimeError("Invalid question for this option")
+                submitted_questions.add(vote_question)
+                ranks.setdefault(question_id, {})[vote] = rank
+        if submitted_questions != self.question_ids:
+            raise RuntimeError("Did not submit a complete ballot!")
+        rankings = {}
+        for question_id, option_ranks in ranks.items():
+            # Ranks must be 1, 2, ... with none repeated or skipped
+            if sorted(option_ranks.values()) != list(range(1, len(option_ranks) + 1)):
+                raise RuntimeError("Options must be ranked 1, 2, 3, ... without gaps")
+            rankings[question_id] = sorted(option_ranks, key=option_ranks.__getitem__)
+        return SubmittedBallot(option_ids=submitted_options, rankings=rankings)
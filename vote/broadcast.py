@@ -0,0 +1,110 @@
+"""
+Fans out changing values to many subscribers from a single poller.
+
+One Broadcaster per worker polls a loader for the keys that currently have
+subscribers and pushes each value that changed to all of them. With a loader
+that reads through the DataCache, thousands of subscribers cost one load per
+change rather than one per client.
+"""
+import asyncio
+import contextlib
+import logging
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+
+
+class Broadcaster(Generic[K]):
+    """
+    Publishes load(keys)[key] to the subscribers of each key whenever it changes.
+
+    A key missing from the loaded values (e.g. a deleted election) sends None
+    and ends its subscriptions. Subscribers only ever get the latest value: a
+    slow client skips intermediate values instead of queueing them.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[Iterable[K]], Awaitable[Dict[K, Any]]],
+        interval: float = 1.0,
+    ):
+        self._load = load
+        self._interval = interval
+        self._subscribers: Dict[K, Set[asyncio.Queue]] = {}
+        self._latest: Dict[K, Any] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @contextlib.contextmanager
+    def subscribe(self, key: K) -> Iterator[asyncio.Queue]:
+        """Yields a queue that receives the current value of key, then every change"""
+        updates: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(key, set()).add(updates)
+        if key in self._latest:
+            updates.put_nowait(self._latest[key])
+        else:
+            self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            yield updates
+        finally:
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(updates)
+                if len(subscribers) == 0:
+                    del self._subscribers[key]
+                    self._latest.pop(key, None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        for subscribers in self._subscribers.values():
+            for updates in subscribers:
+                self._send(updates, None)
+
+    async def _run(self):
+        while len(self._subscribers) > 0:
+            self._wake.clear()
+            keys = list(self._subscribers)
+            try:
+                values = await self._load(keys)
+            except Exception:
+                # Subscribers keep the last values; the next poll retries
+                logger.exception("Failed to load values to broadcast")
+            else:
+                self._publish(keys, values)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+
+    def _publish(self, keys: Iterable[K], values: Dict[K, Any]):
+        for key in keys:
+            value = values.get(key)
+            if key in self._latest and self._latest[key] == value:
+                continue
+            if value is not None:
+                self._latest[key] = value
+            for updates in self._subscribers.get(key, ()):
+                self._send(updates, value)
+
+    @staticmethod
+    def _send(updates: asyncio.Queue, value: Any):
+        if updates.full():
+            updates.get_nowait()
+        updates.put_nowait(value)
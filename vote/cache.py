@@ -0,0 +1,100 @@
+"""
+Per-process read-through cache for data shared by every request.
+
+Writers bump a named counter in the data_versions table in the same
+transaction as their change. Readers poll SQLite's data_version pragma on a
+dedicated connection, which only changes when another connection (in this
+or any other process) commits, and re-read the counters only then. Cached
+entries record the counters they were built from and are rebuilt when any
+of them moves.
+
+Polling is a synchronous call on the event loop, but it only reads SQLite's
+shared memory index unless the database changed, which is cheaper than
+handing it to another thread.
+"""
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Tuple, TypeVar
+
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .models import DataVersion
+
+# Election, question and option definitions (changed by the CLI)
+STRUCTURE = "structure"
+# Vote counts (changed by every ballot)
+TALLIES = "tallies"
+# Frozen results of closed elections
+SNAPSHOTS = "snapshots"
+
+T = TypeVar("T")
+
+
+def bump_versions(session: Session, *names: str):
+    """Increments the given version counters. Call inside the transaction making the change."""
+    stmt = sqlalchemy.dialects.sqlite.insert(DataVersion).values(
+        [{"name": name, "value": 1} for name in names]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DataVersion.name],
+        set_={"value": DataVersion.value + 1},
+    )
+    session.execute(stmt)
+
+
+class DataCache:
+    def __init__(self, engine: sqlalchemy.Engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._connection: Any = None
+        self._data_version = None
+        self._versions: Dict[str, int] = {}
+        self._entries: Dict[Hashable, Tuple[Tuple[int, ...], Any]] = {}
+
+    def versions(self) -> Dict[str, int]:
+        """Returns the current version counters, querying them only if the database changed"""
+        with self._lock:
+            if self._connection is None:
+                # Held for the life of the process so data_version stays meaningful
+                self._connection = self._engine.raw_connection()
+            cursor = self._connection.cursor()
+            try:
+                data_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+                if data_version != self._data_version:
+                    self._versions = dict(
+                        cursor.execute(
+                            f"SELECT name, value FROM {DataVersion.__tablename__}"
+                        ).fetchall()
+                    )
+                    self._data_version = data_version
+            finally:
+                cursor.close()
+            return self._versions
+
+    def close(self):
+        """Closes the polling connection; the next call to versions() opens a new one"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+                # data_version is only comparable on the same connection
+                self._data_version = None
+
+    async def get(
+        self,
+        key: Hashable,
+        depends_on: Iterable[str],
+        loader: Callable[[], Awaitable[T]],
+    ) -> T:
+        """Returns the cached value for key, awaiting loader if any of the depends_on versions changed"""
+        versions = self.versions()
+        stamp = tuple(versions.get(name, 0) for name in depends_on)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        # Versions are read before loading, so a concurrent write can only make
+        # the stored stamp too old (forcing another reload), never too new.
+        value = await loader()
+        self._entries[key] = (stamp, value)
+        return value
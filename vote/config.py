@@ -0,0 +1,77 @@
+from typing import Dict
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    database_url: str = "sqlite:////var/lib/vote-daemon/elections.db"
+    # Optional read-only copy of the database that cached page data is loaded from
+    database_replica_url: str = ""
+    # Connections kept open per engine in each process, and extra ones allowed under load
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout_s: float = 30.0
+    csrf_key: str = ""
+    # Secret used to shuffle vote ids; required, and must be kept away from the
+    # database and its state directory (see systemd/gunicorn.service)
+    vote_id_key: str = ""
+    base_url: str = "http://localhost:9000"
+    smtp_host: str = "outgoing.mit.edu"
+    smtp_port: int = 587
+    # Disable to test against a local debugging server without TLS
+    smtp_starttls: bool = True
+    smtp_username: str = ""
+    smtp_password: str = ""
+    # Open SMTP connections kept by the mailer process, and its total send rate
+    smtp_pool_size: int = 2
+    smtp_max_per_second: float = 5.0
+    # The mailer process (python -m vote mailer): emails sent per batch, how
+    # often it checks for new ones, and how failed sends are retried
+    mailer_batch_size: int = 50
+    mailer_poll_interval_s: float = 1.0
+    mailer_max_attempts: int = 8
+    mailer_retry_base_s: float = 30.0
+    # Where the mailer serves its own /metrics (directory and SMTP latency); 0 disables it
+    mailer_metrics_address: str = "127.0.0.1"
+    mailer_metrics_port: int = 9101
+    session_lifetime_minutes: int = 60
+    # Sliding expirations are only written back once this fraction of the
+    # lifetime has elapsed, so most page views stay read-only.
+    session_refresh_fraction: float = 0.25
+    sqlite_journal_mode: str = "wal"
+    sqlite_busy_timeout_ms: int = 10000
+    # Extra PRAGMAs run on every connection, e.g. {"synchronous": "normal"}
+    sqlite_pragmas: Dict[str, str] = {}
+    # Most ballots committed together in one transaction
+    ballot_batch_size: int = 500
+    # The retention job (python -m vote retention) deletes sessions and login
+    # tokens this long after they expire, this many rows per transaction
+    retention_grace_hours: float = 24.0
+    retention_batch_size: int = 1000
+    # The kerberos is appended to this URL
+    directory_url: str = "https://tlepeopledir.mit.edu/q/"
+    directory_timeout_s: float = 5.0
+    # How long a kerberos found not to be a grad student is remembered
+    directory_negative_ttl_s: float = 600.0
+    directory_max_connections: int = 10
+    # File holding the login request rate limits, shared by all workers
+    rate_limit_path: str = "/tmp/vote-ratelimit"
+    # Login requests allowed at once per kerberos and per client address, and
+    # how often another one is allowed
+    login_kerberos_burst: int = 2
+    login_kerberos_interval_s: float = 300.0
+    login_address_burst: int = 20
+    login_address_interval_s: float = 6.0
+    # How often each worker checks for new results to push to /elections/{id}/stream
+    results_poll_interval_s: float = 1.0
+
+    # Trace the SQL statements of requests sent with an X-Query-Trace header
+    query_trace_header: bool = False
+    # Trace the SQL statements of every request
+    query_trace_all: bool = False
+
+    class Config:
+        secrets_dir = "/var/lib/vote-daemon/secrets"
+
+
+settings = Settings()
@@ -0,0 +1,75 @@
+"""
+Engine setup shared by the web server and the CLI.
+
+With database_replica_url set, the web server also opens a read-only replica
+(any copy of the SQLite file kept up to date by another process, such as
+LiteFS or Litestream) and loads cached page data from it.
+"""
+import re
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from .config import Settings
+
+_PRAGMA_NAME = re.compile(r"^[a-z_]+$")
+
+
+def _set_sqlite_pragmas(engine: sqlalchemy.Engine, settings: Settings, replica: bool):
+    for name in settings.sqlite_pragmas:
+        if _PRAGMA_NAME.match(name) is None:
+            raise ValueError(f"Invalid SQLite pragma {name}")
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if replica:
+            # Guards against accidental writes; the journal mode is the primary's
+            cursor.execute("PRAGMA query_only = ON")
+        else:
+            cursor.execute(f"PRAGMA journal_mode = {settings.sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout = {settings.sqlite_busy_timeout_ms}")
+        for name, value in settings.sqlite_pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def _pool_options(settings: Settings):
+    return {
+        "pool_size": settings.database_pool_size,
+        "max_overflow": settings.database_max_overflow,
+        "pool_timeout": settings.database_pool_timeout_s,
+    }
+
+
+def _url(settings: Settings, replica: bool) -> str:
+    if replica:
+        if settings.database_replica_url == "":
+            raise ValueError("No database_replica_url is set")
+        return settings.database_replica_url
+    return settings.database_url
+
+
+def create_engine(settings: Settings, replica: bool = False) -> sqlalchemy.Engine:
+    engine = sqlalchemy.create_engine(
+        _url(settings, replica), echo=False, **_pool_options(settings)
+    )
+    _set_sqlite_pragmas(engine, settings, replica)
+    return engine
+
+
+def create_async_engine(
+    settings: Settings, replica: bool = False
+) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    url = sqlalchemy.make_url(_url(settings, replica)).set(
+        drivername="sqlite+aiosqlite"
+    )
+    # aiosqlite defaults to opening a new connection for every checkout
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url,
+        echo=False,
+        poolclass=sqlalchemy.pool.AsyncAdaptedQueuePool,
+        **_pool_options(settings),
+    )
+    _set_sqlite_pragmas(engine.sync_engine, settings, replica)
+    return engine
@@ -0,0 +1,101 @@
+"""
+Client for the MIT people directory, used to check that a kerberos belongs to a grad student.
+"""
+import asyncio
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import httpx
+
+from .metrics import DIRECTORY_LATENCY
+
+
+class DirectoryClient:
+    """
+    Looks up kerberos names over a pooled keep-alive connection.
+
+    Negative answers are remembered for negative_ttl seconds so that typos and
+    ineligible users retrying do not each cost a round-trip, and concurrent
+    lookups of the same kerberos share one request. Positive answers are
+    cached in the database by the caller. Network and parsing failures are
+    raised and never cached.
+    """
+
+    # Expired negative answers are purged once this many are remembered
+    max_negative_entries = 10000
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 5.0,
+        negative_ttl: float = 600.0,
+        max_connections: int = 10,
+    ):
+        self._url = url
+        self._timeout = timeout
+        self._negative_ttl = negative_ttl
+        self._max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        self._not_eligible: Dict[str, float] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def is_grad_student(self, kerberos: str) -> bool:
+        expiry = self._not_eligible.get(kerberos)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return False
+            del self._not_eligible[kerberos]
+
+        lookup = self._in_flight.get(kerberos)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup(kerberos))
+            self._in_flight[kerberos] = lookup
+            lookup.add_done_callback(lambda _: self._in_flight.pop(kerberos, None))
+        # Shielded so one caller going away does not cancel the others' lookup
+        return await asyncio.shield(lookup)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _lookup(self, kerberos: str) -> bool:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self._timeout,
+                limits=httpx.Limits(
+                    max_connections=self._max_connections,
+                    max_keepalive_connections=self._max_connections,
+                ),
+            )
+        with DIRECTORY_LATENCY.time():
+            r = await self._client.get(
+                self._url + urllib.parse.quote(kerberos, safe=""),
+                params={"_format": "json"},
+            )
+        r.raise_for_status()
+        lookup = r.json()
+        if "result" in lookup:
+            for result in lookup["result"]:
+                if (
+                    "email_id" in result
+                    and result["email_id"] == kerberos
+                    and "email_domain" in result
+                    and result["email_domain"] == "mit.edu"
+                    and "student_year" in result
+                    and result["student_year"] == "G"
+                ):
+                    return True
+        self._remember_not_eligible(kerberos)
+        return False
+
+    def _remember_not_eligible(self, kerberos: str):
+        now = time.monotonic()
+        if len(self._not_eligible) >= self.max_negative_entries:
+            self._not_eligible = {
+                k: expiry for k, expiry in self._not_eligible.items() if expiry > now
+            }
+            if len(self._not_eligible) >= self.max_negative_entries:
+                self._not_eligible.clear()
+        self._not_eligible[kerberos] = now + self._negative_ttl
@@ -0,0 +1,134 @@
+"""
+Bulk maintenance of the cached_eligible table: roster imports and directory revalidation.
+"""
+import asyncio
+import csv
+import datetime
+from typing import Dict, Iterable, Iterator, List, TextIO
+
+import httpx
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .directory import DirectoryClient
+from .models import VoterEligibility
+
+
+def normalize_kerberos(kerberos: str) -> str:
+    kerberos = kerberos.strip().lower()
+    if kerberos.endswith("@mit.edu"):
+        kerberos = kerberos[: -len("@mit.edu")]
+    return kerberos
+
+
+def read_roster(f: TextIO, column: str) -> Iterator[str]:
+    """Yields kerberos names from a CSV roster with a header row"""
+    for row in csv.DictReader(f):
+        if row.get(column) is None:
+            raise ValueError(f"Roster has no {column} column")
+        kerberos = normalize_kerberos(row[column])
+        if kerberos != "":
+            yield kerberos
+
+
+def _batches(items: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def import_roster(
+    engine: sqlalchemy.Engine, kerberos_names: Iterable[str], batch_size: int = 5000
+) -> int:
+    """Marks every given kerberos as eligible, committing once per batch. Returns the count."""
+    count = 0
+    for batch in _batches(kerberos_names, batch_size):
+        now = datetime.datetime.now()
+        stmt = sqlalchemy.dialects.sqlite.insert(VoterEligibility)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[VoterEligibility.kerberos],
+            set_={"checked_at": stmt.excluded.checked_at},
+        )
+        # Each batch is its own short transaction so voting is never blocked for long
+        with Session(engine) as session:
+            session.execute(
+                stmt, [{"kerberos": k, "checked_at": now} for k in set(batch)]
+            )
+            session.commit()
+        count += len(batch)
+    return count
+
+
+async def refresh_eligibility(
+    engine: sqlalchemy.Engine,
+    client: DirectoryClient,
+    checked_before: datetime.datetime,
+    concurrency: int = 20,
+    batch_size: int = 500,
+) -> Dict[str, int]:
+    """
+    Re-checks cached entries last confirmed before checked_before against the directory.
+
+    Lookups run with at most concurrency requests in flight. Entries that are
+    still eligible get a new checked_at, entries that are not are deleted, and
+    entries whose lookup failed are left alone. Results are written back once
+    per batch. Returns counts of each outcome.
+    """
+    counts = {"eligible": 0, "removed": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(kerberos: str):
+        async with semaphore:
+            try:
+                return await client.is_grad_student(kerberos)
+            except (httpx.HTTPError, ValueError):
+                return None
+
+    last = ""
+    while True:
+        # Page through the table by key so memory use stays bounded
+        with Session(engine) as session:
+            stmt = (
+                sqlalchemy.select(VoterEligibility.kerberos)
+                .where(VoterEligibility.kerberos > last)
+                .where(
+                    sqlalchemy.or_(
+                        VoterEligibility.checked_at == None,
+                        VoterEligibility.checked_at < checked_before,
+                    )
+                )
+                .order_by(VoterEligibility.kerberos)
+                .limit(batch_size)
+            )
+            batch = list(session.scalars(stmt))
+        if len(batch) == 0:
+            return counts
+        last = batch[-1]
+
+        results = await asyncio.gather(*[check(k) for k in batch])
+        eligible = [k for k, r in zip(batch, results) if r is True]
+        removed = [k for k, r in zip(batch, results) if r is False]
+        counts["eligible"] += len(eligible)
+        counts["removed"] += len(removed)
+        counts["failed"] += len(batch) - len(eligible) - len(removed)
+
+        with Session(engine) as session:
+            if len(eligible) > 0:
+                session.execute(
+                    sqlalchemy.update(VoterEligibility)
+                    .where(VoterEligibility.kerberos.in_(eligible))
+                    .values(checked_at=datetime.datetime.now())
+                )
+            if len(removed) > 0:
+                session.execute(
+                    sqlalchemy.delete(VoterEligibility).where(
+                        VoterEligibility.kerberos.in_(removed)
+                    )
+                )
+            session.commit()
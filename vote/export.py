@@ -0,0 +1,219 @@
+"""
+Election results and raw vote export for the CLI, as CSV, JSON or Parquet.
+
+Results are counted with one aggregate query, plus the first preferences of
+any ranked questions. Exports stream the vote rows
+from the database in batches (without building ORM objects) and write each
+batch out before fetching the next, so memory use does not grow with the
+size of the election. Parquet output needs pyarrow, which is not installed
+by default.
+"""
+import collections
+import csv
+import json
+from typing import IO, Any, Dict, Iterator, List, Sequence
+
+import sqlalchemy
+
+from .models import *
+from .ranked import first_preferences, unpack_ranking
+
+FORMATS = ["csv", "json", "parquet"]
+RESULT_COLUMNS = ["question_id", "question", "option_id", "option", "votes"]
+ResultRow = collections.namedtuple("ResultRow", RESULT_COLUMNS)
+# rank is empty for plurality votes, and 1, 2, ... for the options of a ranked ballot
+VOTE_COLUMNS = ["vote_id", "question_id", "question", "option_id", "option", "rank"]
+# For Parquet
+COLUMN_TYPES = {
+    "vote_id": "int64",
+    "question_id": "int64",
+    "question": "string",
+    "option_id": "int64",
+    "option": "string",
+    "votes": "int64",
+    "rank": "int64",
+}
+
+
+def get_election(connection: sqlalchemy.Connection, election_id: int):
+    election = connection.execute(
+        sqlalchemy.select(
+            Election.id,
+            Election.name,
+            Election.open_timestamp,
+            Election.close_timestamp,
+        ).where(Election.id == election_id)
+    ).first()
+    if election is None:
+        raise ValueError("Invalid election ID")
+    return election
+
+
+def count_results(connection: sqlalchemy.Connection, election_id: int) -> List[Any]:
+    """Returns one row per option (RESULT_COLUMNS), counted from the raw votes or first preferences"""
+    stmt = (
+        sqlalchemy.select(
+            Question.id.label("question_id"),
+            Question.name.label("question"),
+            QuestionOption.id.label("option_id"),
+            QuestionOption.name.label("option"),
+            sqlalchemy.func.count(Vote.id).label("votes"),
+        )
+        .join(QuestionOption, QuestionOption.question_id == Question.id)
+        .outerjoin(Vote, Vote.question_option == QuestionOption.id)
+        .where(Question.election_id == election_id)
+        .group_by(QuestionOption.id)
+        .order_by(Question.id, QuestionOption.id)
+    )
+    rows = connection.execute(stmt).all()
+    ranked_ids = set(
+        connection.scalars(
+            sqlalchemy.select(Question.id).where(
+                Question.election_id == election_id, Question.method != "plurality"
+            )
+        )
+    )
+    counts: Dict[int, int] = {}
+    for question_id in ranked_ids:
+        option_ids = [row.option_id for row in rows if row.question_id == question_id]
+        counts.update(first_preferences(connection, question_id, option_ids))
+    return [
+        ResultRow(*row[:4], counts[row.option_id])
+        if row.question_id in ranked_ids
+        else row
+        for row in rows
+    ]
+
+
+def write_results(
+    connection: sqlalchemy.Connection, election_id: int, format: str, f: IO
+):
+    election = get_election(connection, election_id)
+    rows = count_results(connection, election_id)
+    if format == "json":
+        questions: Dict[int, Dict] = {}
+        for row in rows:
+            question = questions.setdefault(
+                row.question_id,
+                {"id": row.question_id, "name": row.question, "options": []},
+            )
+            question["options"].append(
+                {"id": row.option_id, "name": row.option, "votes": row.votes}
+            )
+        json.dump(
+            {
+                "id": election.id,
+                "name": election.name,
+                "open": election.open_timestamp.isoformat(),
+                "close": election.close_timestamp.isoformat(),
+                "questions": list(questions.values()),
+            },
+            f,
+            indent=2,
+        )
+        f.write("\n")
+    else:
+        _write_batches(iter([rows]), RESULT_COLUMNS, format, f)
+
+
+def export_votes(
+    connection: sqlalchemy.Connection,
+    election_id: int,
+    format: str,
+    f: IO,
+    batch_size: int = 10000,
+) -> int:
+    """
+    Writes one row per stored vote (VOTE_COLUMNS) and returns how many were written.
+
+    Ranked ballots are written as one row per ranked option, sharing the
+    ballot's id as vote_id.
+    """
+    get_election(connection, election_id)
+    stmt = (
+        sqlalchemy.select(
+            Vote.id.label("vote_id"),
+            Question.id.label("question_id"),
+            Question.name.label("question"),
+            QuestionOption.id.label("option_id"),
+            QuestionOption.name.label("option"),
+            sqlalchemy.null().label("rank"),
+        )
+        .join(QuestionOption, QuestionOption.id == Vote.question_option)
+        .join(Question, Question.id == QuestionOption.question_id)
+        .where(Question.election_id == election_id)
+    )
+    result = connection.execution_options(
+        stream_results=True, yield_per=batch_size
+    ).execute(stmt)
+    count = 0
+
+    option_names = dict(
+        connection.execute(
+            sqlalchemy.select(QuestionOption.id, QuestionOption.name)
+            .join(Question, Question.id == QuestionOption.question_id)
+            .where(Question.election_id == election_id)
+        ).all()
+    )
+    ranked_stmt = (
+        sqlalchemy.select(
+            RankedBallot.id,
+            Question.id.label("question_id"),
+            Question.name.label("question"),
+            RankedBallot.ranking,
+        )
+        .join(Question, Question.id == RankedBallot.question_id)
+        .where(Question.election_id == election_id)
+    )
+
+    def batches() -> Iterator[Sequence[Any]]:
+        nonlocal count
+        for batch in result.partitions():
+            count += len(batch)
+            yield batch
+        # Only started once the votes are done, since both stream from one connection
+        ranked = connection.execution_options(
+            stream_results=True, yield_per=batch_size
+        ).execute(ranked_stmt)
+        for ballots in ranked.partitions():
+            batch = [
+                (row.id, row.question_id, row.question, id, option_names[id], rank)
+                for row in ballots
+                for rank, id in enumerate(unpack_ranking(row.ranking), 1)
+            ]
+            count += len(batch)
+            yield batch
+
+    _write_batches(batches(), VOTE_COLUMNS, format, f)
+    return count
+
+
+def _write_batches(
+    batches: Iterator[Sequence[Any]], columns: List[str], format: str, f: IO
+):
+    if format == "csv":
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+    elif format == "json":
+        # One object per line, so that it can be written and read incrementally
+        for batch in batches:
+            for row in batch:
+                f.write(json.dumps(dict(zip(columns, row))) + "\n")
+    elif format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output requires pyarrow (pip install pyarrow)")
+        schema = pyarrow.schema([(c, COLUMN_TYPES[c]) for c in columns])
+        with pyarrow.parquet.ParquetWriter(f, schema) as writer:
+            for batch in batches:
+                writer.write_table(
+                    pyarrow.Table.from_pylist(
+                        [dict(zip(columns, row)) for row in batch], schema=schema
+                    )
+                )
+    else:
+        raise ValueError(f"Unknown format {format}")
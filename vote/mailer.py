@@ -0,0 +1,105 @@
+"""
+Sends email over a small pool of persistent, authenticated SMTP connections.
+"""
+import email.message
+import queue
+import smtplib
+import ssl
+import threading
+import time
+
+from .metrics import SMTP_LATENCY
+
+
+class Mailer:
+    """
+    Thread-safe SMTP client that reuses connections across messages.
+
+    At most pool_size connections are open at once. A connection that the
+    relay has dropped is replaced and the message retried once. Sends are
+    spaced out to at most max_per_second across all threads, so that bursts
+    of login emails do not get throttled by the relay.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str = "",
+        password: str = "",
+        starttls: bool = True,
+        pool_size: int = 2,
+        max_per_second: float = 5.0,
+        timeout: float = 30.0,
+    ):
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._starttls = starttls
+        self._timeout = timeout
+        self._interval = 1 / max_per_second if max_per_second > 0 else 0
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._rate_lock = threading.Lock()
+        self._next_send = 0.0
+
+    def send(self, msg: email.message.EmailMessage):
+        self._wait_for_rate_limit()
+        with self._slots, SMTP_LATENCY.time():
+            connection = self._checkout()
+            try:
+                try:
+                    connection.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # Idle connections get closed by the relay; retry once on a fresh one
+                    self._discard(connection)
+                    connection = self._connect()
+                    connection.send_message(msg)
+            except Exception:
+                self._discard(connection)
+                raise
+            self._idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection, quit=True)
+
+    def _wait_for_rate_limit(self):
+        with self._rate_lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_send)
+            self._next_send = send_at + self._interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+    def _checkout(self) -> smtplib.SMTP:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _connect(self) -> smtplib.SMTP:
+        connection = smtplib.SMTP(self._host, port=self._port, timeout=self._timeout)
+        try:
+            if self._starttls:
+                connection.starttls(context=ssl.create_default_context())
+            if self._username != "":
+                connection.login(self._username, self._password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    @staticmethod
+    def _discard(connection: smtplib.SMTP, quit: bool = False):
+        try:
+            if quit:
+                connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        connection.close()
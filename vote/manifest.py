@@ -0,0 +1,256 @@
+"""
+Creates or updates an election, with its questions and options, from a YAML or JSON manifest.
+
+    name: Contract ratification
+    open: 2023-05-15 09:00
+    close: 2023-05-19 17:00
+    visible: false          # optional, defaults to false for new elections
+    questions:
+      - name: Should the contract be ratified?
+        options: [Yes, No]
+      - name: Bargaining committee
+        method: stv          # optional: plurality (default), irv or stv
+        seats: 2             # optional, for stv only
+        options: [Alice, Bob, Carol]
+
+The election is matched by `id` if the manifest gives one, otherwise by name.
+Questions are matched by name within the election, and options by name
+within their question. Only what differs from the database is written, so
+applying the same manifest again changes nothing. Questions and options
+missing from the manifest are removed, unless ballots have already been cast
+in the election.
+"""
+import datetime
+import json
+import re
+from typing import IO, Any, Dict, List, Tuple
+
+import sqlalchemy
+import yaml
+from sqlalchemy.orm import Session
+
+from .cache import STRUCTURE, bump_versions
+from .models import *
+from .snapshots import discard_snapshot
+
+_BOOL_TAG = "tag:yaml.org,2002:bool"
+
+
+class _ManifestLoader(yaml.SafeLoader):
+    """SafeLoader that keeps yes/no/on/off as strings, since Yes and No are common options"""
+
+
+_ManifestLoader.yaml_implicit_resolvers = {
+    first: [(tag, regexp) for tag, regexp in resolvers if tag != _BOOL_TAG]
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items()
+}
+_ManifestLoader.add_implicit_resolver(
+    _BOOL_TAG, re.compile(r"^(?:true|True|TRUE|false|False|FALSE)$"), list("tTfF")
+)
+
+
+def read_manifest(f: IO) -> Dict[str, Any]:
+    if f.name.endswith(".json"):
+        manifest = json.load(f)
+    else:
+        manifest = yaml.load(f, Loader=_ManifestLoader)
+    if not isinstance(manifest, dict):
+        raise ValueError("The manifest must be a mapping")
+    for key in ("name", "open", "close"):
+        if key not in manifest:
+            raise ValueError(f"The manifest is missing {key}")
+    manifest["open"] = _parse_datetime(manifest["open"])
+    manifest["close"] = _parse_datetime(manifest["close"])
+    if "visible" in manifest:
+        manifest["visible"] = _parse_bool(manifest["visible"], "visible")
+    questions = manifest.setdefault("questions", [])
+    question_names = [question["name"] for question in questions]
+    if len(set(question_names)) != len(question_names):
+        raise ValueError("Question names must be unique")
+    for question in questions:
+        options = [str(option) for option in question.get("options", [])]
+        if len(options) == 0:
+            raise ValueError(f"Question {question['name']!r} has no options")
+        if len(set(options)) != len(options):
+            raise ValueError(f"Question {question['name']!r} has duplicate options")
+        question["options"] = options
+        method = question.setdefault("method", "plurality")
+        if method not in QUESTION_METHODS:
+            raise ValueError(
+                f"Question {question['name']!r} has unknown method {method!r}"
+            )
+        seats = question.setdefault("seats", 1)
+        if not isinstance(seats, int) or seats < 1:
+            raise ValueError(f"Question {question['name']!r} must have at least 1 seat")
+        if method != "stv" and seats != 1:
+            raise ValueError(
+                f"Question {question['name']!r} can only have more than one seat with stv"
+            )
+    return manifest
+
+
+def _parse_bool(value, key: str) -> bool:
+    # The loader leaves yes/no/on/off as strings, see _ManifestLoader
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("yes", "on", "true"):
+        return True
+    if isinstance(value, str) and value.lower() in ("no", "off", "false"):
+        return False
+    raise ValueError(f"{key} must be true or false, not {value!r}")
+
+
+def _parse_datetime(value) -> datetime.datetime:
+    # YAML already parses unquoted timestamps
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(str(value))
+
+
+def apply_manifest(session: Session, manifest: Dict[str, Any]) -> Tuple[int, List[str]]:
+    """Brings the database in line with the manifest and returns the election id and the changes made"""
+    changes: List[str] = []
+    # The name and close time are part of a closed election's snapshot
+    snapshot_changed = False
+    if "id" in manifest:
+        election = session.get(Election, manifest["id"])
+        if election is None:
+            raise ValueError("Invalid election ID")
+    else:
+        elections = session.scalars(
+            sqlalchemy.select(Election).where(Election.name == manifest["name"])
+        ).all()
+        if len(elections) > 1:
+            raise ValueError(
+                f"Several elections are named {manifest['name']!r}; give the id in the manifest"
+            )
+        election = elections[0] if len(elections) == 1 else None
+
+    if election is None:
+        election = Election(
+            name=manifest["name"],
+            visible=bool(manifest.get("visible", False)),
+            open_timestamp=manifest["open"],
+            close_timestamp=manifest["close"],
+        )
+        session.add(election)
+        session.flush()
+        changes.append(f"created election {election.id}")
+        existing: Dict[str, Question] = {}
+        has_ballots = False
+    else:
+        for field, key in (
+            ("name", "name"),
+            ("open_timestamp", "open"),
+            ("close_timestamp", "close"),
+            ("visible", "visible"),
+        ):
+            if key in manifest and getattr(election, field) != manifest[key]:
+                setattr(election, field, manifest[key])
+                changes.append(f"set {key} to {manifest[key]}")
+                snapshot_changed = snapshot_changed or key in ("name", "close")
+        existing = {
+            question.name: question
+            for question in session.scalars(
+                sqlalchemy.select(Question)
+                .where(Question.election_id == election.id)
+                .options(sqlalchemy.orm.selectinload(Question.options))
+            )
+        }
+        has_ballots = (
+            session.scalar(
+                sqlalchemy.select(Voter.kerberos)
+                .where(Voter.election_id == election.id)
+                .limit(1)
+            )
+            is not None
+        )
+
+    wanted = {question["name"]: question for question in manifest["questions"]}
+    new_questions = [name for name in wanted if name not in existing]
+    removed_questions = [q for name, q in existing.items() if name not in wanted]
+    changed_questions: List[Question] = []
+    new_options: List[Tuple[int, str]] = []
+    removed_options: List[QuestionOption] = []
+    for name, question in existing.items():
+        if name not in wanted:
+            continue
+        if (question.method, question.seats) != (
+            wanted[name]["method"],
+            wanted[name]["seats"],
+        ):
+            changed_questions.append(question)
+        options = wanted[name]["options"]
+        option_names = {option.name for option in question.options}
+        new_options += [(question.id, o) for o in options if o not in option_names]
+        removed_options += [o for o in question.options if o.name not in options]
+
+    structure_changed = (
+        len(new_questions)
+        + len(removed_questions)
+        + len(changed_questions)
+        + len(new_options)
+        + len(removed_options)
+        > 0
+    )
+    if structure_changed and has_ballots:
+        raise ValueError(
+            f"Ballots have already been cast in election {election.id}; "
+            "only its name, times and visibility can be changed"
+        )
+
+    if len(new_questions) > 0:
+        rows = session.execute(
+            sqlalchemy.insert(Question).returning(
+                Question.id, Question.name, sort_by_parameter_order=True
+            ),
+            [
+                {
+                    "name": name,
+                    "election_id": election.id,
+                    "method": wanted[name]["method"],
+                    "seats": wanted[name]["seats"],
+                }
+                for name in new_questions
+            ],
+        ).all()
+        new_options += [
+            (row.id, o) for row in rows for o in wanted[row.name]["options"]
+        ]
+        changes.append(f"added {len(new_questions)} questions")
+    for question in changed_questions:
+        question.method = wanted[question.name]["method"]
+        question.seats = wanted[question.name]["seats"]
+        changes.append(
+            f"counted {question.name!r} by {question.method} for {question.seats} seats"
+        )
+    if len(new_options) > 0:
+        session.execute(
+            sqlalchemy.insert(QuestionOption),
+            [{"question_id": id, "name": name} for id, name in new_options],
+        )
+        changes.append(f"added {len(new_options)} options")
+    if len(removed_options) > 0:
+        session.execute(
+            sqlalchemy.delete(QuestionOption).where(
+                QuestionOption.id.in_([o.id for o in removed_options])
+            )
+        )
+        changes.append(f"removed {len(removed_options)} options")
+    if len(removed_questions) > 0:
+        question_ids = [q.id for q in removed_questions]
+        session.execute(
+            sqlalchemy.delete(QuestionOption).where(
+                QuestionOption.question_id.in_(question_ids)
+            )
+        )
+        session.execute(
+            sqlalchemy.delete(Question).where(Question.id.in_(question_ids))
+        )
+        changes.append(f"removed {len(removed_questions)} questions")
+
+    if len(changes) > 0:
+        if structure_changed or snapshot_changed:
+            discard_snapshot(session, election.id)
+        bump_versions(session, STRUCTURE)
+    return election.id, changes
@@ -0,0 +1,114 @@
+"""
+Prometheus metrics for requests and the slow dependencies (database, directory and SMTP).
+
+Each gunicorn worker is a separate process, so when PROMETHEUS_MULTIPROC_DIR
+is set (to an empty directory shared by all workers, see gunicorn.conf.py)
+metrics are written there and /metrics reports totals across all workers.
+Directory lookups and SMTP sends happen in the mailer process, which serves
+its own metrics (see mailer_metrics_port).
+"""
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import sqlalchemy
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+REQUESTS = Counter(
+    "vote_http_requests_total", "HTTP requests", ["method", "route", "status"]
+)
+LOGIN_REQUESTS_LIMITED = Counter(
+    "vote_login_requests_limited_total",
+    "Login requests rejected by the rate limiter",
+    ["key"],
+)
+REQUEST_LATENCY = Histogram(
+    "vote_http_request_duration_seconds",
+    "Time to produce an HTTP response",
+    ["method", "route"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "vote_db_query_duration_seconds",
+    "Time spent executing each SQL statement",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+DIRECTORY_LATENCY = Histogram(
+    "vote_directory_lookup_duration_seconds",
+    "Time spent on people directory requests",
+)
+SMTP_LATENCY = Histogram(
+    "vote_smtp_send_duration_seconds",
+    "Time spent sending one email, including connecting if needed",
+)
+
+
+def instrument_engine(engine: sqlalchemy.Engine):
+    """Times every statement run on the engine. For async engines, pass engine.sync_engine."""
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["metrics_query_start"].pop()
+        DB_QUERY_LATENCY.observe(time.perf_counter() - start)
+
+
+def render() -> Tuple[bytes, str]:
+    """Returns the metrics exposition and its content type"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """ASGI middleware that counts and times requests by route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: Optional[Dict] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self._route_path(scope)
+            REQUEST_LATENCY.labels(scope["method"], route).observe(
+                time.perf_counter() - start
+            )
+            REQUESTS.labels(scope["method"], route, str(status)).inc()
+
+    def _route_path(self, scope) -> str:
+        # The router records the matched endpoint in the scope; label by its
+        # path template so ids and tokens do not create new label values
+        if self._route_paths is None:
+            self._route_paths = {}
+            for route in scope["app"].routes:
+                endpoint = getattr(route, "endpoint", None) or getattr(route, "app")
+                self._route_paths[endpoint] = route.path
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
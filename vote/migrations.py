@@ -0,0 +1,101 @@
+"""
+Creates the database schema and upgrades existing databases.
+
+Each step in MIGRATIONS runs once, in order, and the number of applied steps
+is tracked in the SQLite user_version pragma. New databases are created with
+the current schema and skip the steps entirely.
+"""
+import sqlalchemy
+
+from .config import settings
+from .models import BrowserSession, LoginToken, OrmBase, Vote
+from .tally import rebuild_tallies
+from .voteids import VoteIdAllocator
+
+
+def _backfill_option_tallies(connection: sqlalchemy.Connection):
+    # Databases created before option_tallies existed already have votes
+    rebuild_tallies(connection)
+
+
+def _add_eligibility_checked_at(connection: sqlalchemy.Connection):
+    connection.exec_driver_sql(
+        "ALTER TABLE cached_eligible ADD COLUMN checked_at DATETIME"
+    )
+
+
+def _renumber_votes(connection: sqlalchemy.Connection):
+    # Votes used to get random 32-bit ids, which could collide. Move them to
+    # the collision-free ids (all above that range), in random order.
+    old_ids = list(
+        connection.execute(
+            sqlalchemy.select(Vote.id).order_by(sqlalchemy.func.random())
+        ).scalars()
+    )
+    new_ids = VoteIdAllocator.from_settings(settings).allocate(connection, len(old_ids))
+    if len(old_ids) > 0:
+        votes = Vote.__table__
+        connection.execute(
+            sqlalchemy.update(votes)
+            .where(votes.c.id == sqlalchemy.bindparam("old_id"))
+            .values(id=sqlalchemy.bindparam("new_id")),
+            [{"old_id": old, "new_id": new} for old, new in zip(old_ids, new_ids)],
+        )
+
+
+def _add_retention_indexes(connection: sqlalchemy.Connection):
+    # Token lookups and the retention job's deletes by expiration
+    for table in (BrowserSession.__table__, LoginToken.__table__):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _add_question_method(connection: sqlalchemy.Connection):
+    # Existing questions are all plurality
+    connection.exec_driver_sql(
+        "ALTER TABLE questions ADD COLUMN method VARCHAR NOT NULL DEFAULT 'plurality'"
+    )
+    connection.exec_driver_sql(
+        "ALTER TABLE questions ADD COLUMN seats INTEGER NOT NULL DEFAULT 1"
+    )
+
+
+MIGRATIONS = [
+    _backfill_option_tallies,
+    _add_eligibility_checked_at,
+    _renumber_votes,
+    _add_retention_indexes,
+    _add_question_method,
+]
+
+
+def is_current(engine: sqlalchemy.Engine) -> bool:
+    """Whether the schema is up to date, checked with a single query"""
+    with engine.connect() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        tables = set(
+            connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).scalars()
+        )
+    return version == len(MIGRATIONS) and tables.issuperset(OrmBase.metadata.tables)
+
+
+def migrate(engine: sqlalchemy.Engine):
+    if is_current(engine):
+        return
+    is_new = len(sqlalchemy.inspect(engine).get_table_names()) == 0
+    if is_new:
+        # Lets the retention job return free pages a few at a time. In WAL
+        # mode the setting only takes effect through a VACUUM, which is
+        # instant while the database is empty.
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+    with engine.begin() as connection:
+        OrmBase.metadata.create_all(connection)
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        if not is_new:
+            for step in MIGRATIONS[version:]:
+                step(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
@@ -1,9 +1,8 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 import datetime
-import uuid
 
 from sqlalchemy import ForeignKey
-from sqlalchemy import String, DateTime, Boolean
+from sqlalchemy import String, DateTime, Boolean, Integer, JSON, LargeBinary
 import sqlalchemy.orm
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -18,9 +17,8 @@ class Vote(OrmBase):
 
     __tablename__ = "votes"
 
-    id: Mapped[int] = mapped_column(
-        primary_key=True, default=lambda: uuid.uuid4().int >> (128 - 32)
-    )
+    # Assigned by VoteIdAllocator, so that ids do not reveal the order of votes
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
     question_option: Mapped[int] = mapped_column(ForeignKey("question_options.id"))
 
 
@@ -41,6 +39,8 @@ class VoterEligibility(OrmBase):
     __tablename__ = "cached_eligible"
 
     kerberos: Mapped[str] = mapped_column(String, primary_key=True)
+    # When eligibility was last confirmed by the directory or a roster import
+    checked_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
 
 
 class BrowserSession(OrmBase):
@@ -51,16 +51,32 @@ class BrowserSession(OrmBase):
     id: Mapped[int] = mapped_column(primary_key=True)
     kerberos: Mapped[str] = mapped_column(String)
     cookie: Mapped[str] = mapped_column(String, index=True)
-    expiration: Mapped[datetime.datetime] = mapped_column(DateTime)
+    expiration: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
 
 
 class LoginToken(OrmBase):
     __tablename__ = "login_tokens"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    kerberos: Mapped[str] = mapped_column(String)
-    token: Mapped[str] = mapped_column(String)
-    expiration: Mapped[datetime.datetime] = mapped_column(DateTime)
+    kerberos: Mapped[str] = mapped_column(String, index=True)
+    token: Mapped[str] = mapped_column(String, index=True)
+    expiration: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
+
+
+class OutboxEmail(OrmBase):
+    """Stores requested login emails until the mailer process has sent them"""
+
+    __tablename__ = "email_outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kerberos: Mapped[str] = mapped_column(String, index=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # None once the mailer has given up on the email
+    next_attempt_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        DateTime, index=True
+    )
+    last_error: Mapped[Optional[str]] = mapped_column(String)
 
 
 class Election(OrmBase):
@@ -87,6 +103,10 @@ class Question(OrmBase):
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String)
     election_id: Mapped[int] = mapped_column(ForeignKey("elections.id"))
+    # One of QUESTION_METHODS; ranked questions are counted by vote.ranked
+    method: Mapped[str] = mapped_column(String, default="plurality")
+    # Winners elected by an stv question
+    seats: Mapped[int] = mapped_column(Integer, default=1)
 
     election: Mapped["Election"] = relationship(back_populates="questions")
 
@@ -95,6 +115,9 @@ class Question(OrmBase):
     )
 
 
+QUESTION_METHODS = ["plurality", "irv", "stv"]
+
+
 class QuestionOption(OrmBase):
     """Stores options for these ballot questions"""
 
@@ -105,3 +128,62 @@ class QuestionOption(OrmBase):
     question_id: Mapped[int] = mapped_column(ForeignKey("questions.id"))
 
     question: Mapped["Question"] = relationship(back_populates="options")
+
+
+class RankedBallot(OrmBase):
+    """Stores one voter's ranking for a ranked question, without the voter"""
+
+    __tablename__ = "ranked_ballots"
+
+    # Assigned by VoteIdAllocator, like vote ids
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    question_id: Mapped[int] = mapped_column(ForeignKey("questions.id"), index=True)
+    # Option ids in order of preference, packed by vote.ranked.pack_ranking
+    ranking: Mapped[bytes] = mapped_column(LargeBinary)
+
+
+class OptionTally(OrmBase):
+    """Stores the running vote count for each question option"""
+
+    __tablename__ = "option_tallies"
+
+    question_option_id: Mapped[int] = mapped_column(
+        ForeignKey("question_options.id"), primary_key=True
+    )
+    votes: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class VoteCounter(OrmBase):
+    """Stores the number of the next vote, for allocating vote ids (a single row)"""
+
+    __tablename__ = "vote_counter"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    next_number: Mapped[int] = mapped_column(Integer)
+    # Identifies the key the ids were permuted with, without revealing it
+    key_check: Mapped[str] = mapped_column(String)
+
+
+class DataVersion(OrmBase):
+    """Stores counters that are bumped whenever a class of cached data changes"""
+
+    __tablename__ = "data_versions"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    value: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class ElectionSnapshot(OrmBase):
+    """Stores the final results of a closed election, computed once"""
+
+    __tablename__ = "election_snapshots"
+
+    election_id: Mapped[int] = mapped_column(
+        ForeignKey("elections.id"), primary_key=True
+    )
+    # The close time the results were computed for; stale if the election's changes
+    close_timestamp: Mapped[datetime.datetime] = mapped_column(DateTime)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    results: Mapped[Dict[str, Any]] = mapped_column(JSON)
+    # Pre-rendered homepage card
+    html: Mapped[str] = mapped_column(String)
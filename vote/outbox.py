@@ -0,0 +1,247 @@
+"""
+Login emails, sent from the email_outbox table by the `python -m vote mailer` process.
+
+The web server only records who asked for a login link, so requests never
+wait on the directory or the mail relay, and a restart loses nothing. The
+mailer claims due rows in batches, checks that each kerberos is eligible
+(cached_eligible first, then the directory), commits a fresh login token and
+only then sends the email. Rows are deleted once sent, or once the kerberos
+turns out not to be eligible. Failures are retried with exponential backoff
+until max_attempts. Claims are leases, so the rows of a mailer that dies
+mid-batch are picked up again once the lease runs out.
+"""
+import asyncio
+import datetime
+import email.headerregistry
+import email.message
+import logging
+import secrets
+from typing import Any, Dict, List, Set
+
+import httpx
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .directory import DirectoryClient
+from .mailer import Mailer
+from .models import *
+from .rendering import templates
+
+logger = logging.getLogger(__name__)
+
+# How long a claimed batch is reserved for the mailer that claimed it
+LEASE = datetime.timedelta(minutes=5)
+TOKEN_LIFETIME = datetime.timedelta(minutes=10)
+# Longest wait between attempts
+MAX_BACKOFF = datetime.timedelta(hours=1)
+
+
+def build_login_email(
+    kerberos: str, token: str, base_url: str
+) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    msg["Subject"] = "Voting login link"
+    msg["From"] = email.headerregistry.Address(
+        display_name="Grad voting system (uenotformit)",
+        addr_spec="uenotformit-contributors@mit.edu",
+    )
+    msg["To"] = email.headerregistry.Address(addr_spec=f"{kerberos}@mit.edu")
+    msg.set_content(
+        templates.get_template("token_email.txt").render(
+            {"url": f"{base_url}/login/{token}"}
+        )
+    )
+    return msg
+
+
+def claim_batch(
+    engine: sqlalchemy.Engine, batch_size: int, now: datetime.datetime
+) -> List[Any]:
+    """Leases up to batch_size due emails and returns their (id, kerberos, attempts)"""
+    due = (
+        sqlalchemy.select(OutboxEmail.id)
+        .where(OutboxEmail.next_attempt_at <= now)
+        .order_by(OutboxEmail.next_attempt_at)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    with engine.begin() as connection:
+        return connection.execute(
+            sqlalchemy.update(OutboxEmail)
+            .where(OutboxEmail.id.in_(due))
+            .values(next_attempt_at=now + LEASE)
+            .returning(OutboxEmail.id, OutboxEmail.kerberos, OutboxEmail.attempts)
+        ).all()
+
+
+async def find_eligible(
+    engine: sqlalchemy.Engine, directory: DirectoryClient, kerberos_names: Set[str]
+) -> Dict[str, bool]:
+    """Checks eligibility of each kerberos. Names whose directory lookup failed are left out."""
+    with Session(engine) as session:
+        cached = set(
+            session.scalars(
+                sqlalchemy.select(VoterEligibility.kerberos).where(
+                    VoterEligibility.kerberos.in_(kerberos_names)
+                )
+            )
+        )
+    unknown = list(kerberos_names - cached)
+    results = await asyncio.gather(
+        *[directory.is_grad_student(k) for k in unknown], return_exceptions=True
+    )
+    eligible = {k: True for k in cached}
+    for kerberos, result in zip(unknown, results):
+        if isinstance(result, (httpx.HTTPError, ValueError)):
+            logger.warning("Directory lookup for %s failed: %r", kerberos, result)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            eligible[kerberos] = result
+    newly_eligible = [k for k in unknown if eligible.get(k) is True]
+    if len(newly_eligible) > 0:
+        now = datetime.datetime.now()
+        with Session(engine) as session:
+            session.execute(
+                sqlalchemy.dialects.sqlite.insert(VoterEligibility)
+                .values([{"kerberos": k, "checked_at": now} for k in newly_eligible])
+                .on_conflict_do_nothing()
+            )
+            session.commit()
+    return eligible
+
+
+async def dispatch_batch(
+    engine: sqlalchemy.Engine,
+    mailer: Mailer,
+    directory: DirectoryClient,
+    base_url: str,
+    batch_size: int = 50,
+    max_attempts: int = 8,
+    retry_base: datetime.timedelta = datetime.timedelta(seconds=30),
+) -> Dict[str, int]:
+    """Sends one batch of due emails and returns counts of each outcome"""
+    counts = {"sent": 0, "ineligible": 0, "retried": 0, "failed": 0}
+    now = datetime.datetime.now()
+    batch = claim_batch(engine, batch_size, now)
+    if len(batch) == 0:
+        return counts
+    eligible = await find_eligible(engine, directory, {row.kerberos for row in batch})
+
+    errors: Dict[int, str] = {}
+    done: List[int] = []
+    to_send = []
+    for row in batch:
+        if row.kerberos not in eligible:
+            errors[row.id] = "directory lookup failed"
+        elif not eligible[row.kerberos]:
+            done.append(row.id)
+            counts["ineligible"] += 1
+        else:
+            to_send.append(row)
+
+    # The token must be usable before the link can arrive
+    tokens = [secrets.token_urlsafe(64) for _ in to_send]
+    if len(to_send) > 0:
+        with Session(engine) as session:
+            session.execute(
+                sqlalchemy.insert(LoginToken),
+                [
+                    {
+                        "kerberos": row.kerberos,
+                        "token": token,
+                        "expiration": datetime.datetime.now() + TOKEN_LIFETIME,
+                    }
+                    for row, token in zip(to_send, tokens)
+                ],
+            )
+            session.commit()
+
+    # The mailer bounds how many of these are in flight on its connections
+    results = await asyncio.gather(
+        *[
+            asyncio.to_thread(
+                mailer.send, build_login_email(row.kerberos, token, base_url)
+            )
+            for row, token in zip(to_send, tokens)
+        ],
+        return_exceptions=True,
+    )
+    for row, result in zip(to_send, results):
+        if isinstance(result, Exception):
+            errors[row.id] = repr(result)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            done.append(row.id)
+            counts["sent"] += 1
+
+    retries = []
+    now = datetime.datetime.now()
+    for row in batch:
+        if row.id not in errors:
+            continue
+        attempts = row.attempts + 1
+        if attempts >= max_attempts:
+            next_attempt_at = None
+            counts["failed"] += 1
+            logger.error(
+                "Giving up on login email %d to %s: %s",
+                row.id,
+                row.kerberos,
+                errors[row.id],
+            )
+        else:
+            next_attempt_at = now + min(retry_base * 2 ** (attempts - 1), MAX_BACKOFF)
+            counts["retried"] += 1
+        retries.append(
+            {
+                "email_id": row.id,
+                "attempts": attempts,
+                "next_attempt_at": next_attempt_at,
+                "last_error": errors[row.id],
+            }
+        )
+    with engine.begin() as connection:
+        if len(done) > 0:
+            connection.execute(
+                sqlalchemy.delete(OutboxEmail).where(OutboxEmail.id.in_(done))
+            )
+        if len(retries) > 0:
+            outbox = OutboxEmail.__table__
+            connection.execute(
+                sqlalchemy.update(outbox)
+                .where(outbox.c.id == sqlalchemy.bindparam("email_id"))
+                .values(
+                    attempts=sqlalchemy.bindparam("attempts"),
+                    next_attempt_at=sqlalchemy.bindparam("next_attempt_at"),
+                    last_error=sqlalchemy.bindparam("last_error"),
+                ),
+                retries,
+            )
+    return counts
+
+
+async def run_mailer(
+    engine: sqlalchemy.Engine,
+    mailer: Mailer,
+    directory: DirectoryClient,
+    base_url: str,
+    poll_interval: float = 1.0,
+    once: bool = False,
+    **options,
+):
+    """Dispatches batches until stopped, or with once until nothing is due"""
+    while True:
+        counts = await dispatch_batch(engine, mailer, directory, base_url, **options)
+        if sum(counts.values()) > 0:
+            logger.info(
+                "Sent %(sent)d, not eligible %(ineligible)d, "
+                "retrying %(retried)d, gave up %(failed)d",
+                counts,
+            )
+        elif once:
+            return
+        else:
+            await asyncio.sleep(poll_interval)
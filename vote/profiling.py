@@ -0,0 +1,143 @@
+"""
+Per-request SQL statement tracing, and a query budget check for tests.
+
+When tracing is enabled for a request (with the X-Query-Trace header if
+query_trace_header is set, or for every request if query_trace_all is set),
+every statement it runs is recorded with its duration. The response gets
+X-Query-Count and Server-Timing headers and the full trace is logged to the
+"vote.profiling" logger. Statement parameters are never recorded, since
+they include session cookies and login tokens.
+
+Ballots are committed by the writer thread, so those statements are not
+attributed to the request that submitted them.
+"""
+import contextlib
+import contextvars
+import dataclasses
+import logging
+import time
+from typing import Iterator, List, Optional
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "x-query-trace"
+
+
+@dataclasses.dataclass
+class TracedQuery:
+    statement: str
+    duration: float
+
+
+_trace: contextvars.ContextVar[Optional[List[TracedQuery]]] = contextvars.ContextVar(
+    "query_trace", default=None
+)
+
+
+def instrument_engine(engine: sqlalchemy.Engine):
+    """Records statements into the active trace. For async engines, pass engine.sync_engine."""
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def start_trace_timer(conn, cursor, statement, parameters, context, executemany):
+        if _trace.get() is not None:
+            conn.info.setdefault("trace_query_start", []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def record_trace(conn, cursor, statement, parameters, context, executemany):
+        trace = _trace.get()
+        if trace is not None:
+            start = conn.info["trace_query_start"].pop()
+            trace.append(TracedQuery(statement, time.perf_counter() - start))
+
+
+@contextlib.contextmanager
+def trace_queries() -> Iterator[List[TracedQuery]]:
+    """Collects the statements run in this context (including awaited tasks) into a list"""
+    trace: List[TracedQuery] = []
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+class QueryTraceMiddleware:
+    """ASGI middleware that traces the requests asking for it"""
+
+    def __init__(self, app, header_enabled: bool = False, trace_all: bool = False):
+        self.app = app
+        self.header_enabled = header_enabled
+        self.trace_all = trace_all
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wants_trace(scope):
+            await self.app(scope, receive, send)
+            return
+
+        with trace_queries() as trace:
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    total_ms = sum(q.duration for q in trace) * 1000
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-query-count", str(len(trace)).encode("latin-1")),
+                        (
+                            b"server-timing",
+                            f'db;dur={total_ms:.2f};desc="{len(trace)} queries"'.encode(
+                                "latin-1"
+                            ),
+                        ),
+                    ]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                logger.info(
+                    "%s %s ran %d queries in %.2f ms:\n%s",
+                    scope["method"],
+                    scope["path"],
+                    len(trace),
+                    sum(q.duration for q in trace) * 1000,
+                    "\n".join(
+                        f"  {q.duration * 1000:8.2f} ms  {' '.join(q.statement.split())}"
+                        for q in trace
+                    ),
+                )
+
+    def _wants_trace(self, scope) -> bool:
+        if self.trace_all:
+            return True
+        if not self.header_enabled:
+            return False
+        return any(
+            name == TRACE_HEADER.encode("latin-1") for name, _ in scope["headers"]
+        )
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def assert_max_queries(client, max_queries: int, method: str, url: str, **kwargs):
+    """
+    Test helper: makes a traced request and fails if it ran more than max_queries statements.
+
+    client is a fastapi.testclient.TestClient (or any httpx-style client) for
+    an app with query_trace_header enabled. Returns the response.
+    """
+    headers = {**kwargs.pop("headers", {}), TRACE_HEADER: "1"}
+    r = client.request(method, url, headers=headers, **kwargs)
+    count = r.headers.get("x-query-count")
+    if count is None:
+        raise AssertionError(
+            f"{method} {url} was not traced; is query_trace_header enabled?"
+        )
+    if int(count) > max_queries:
+        raise QueryBudgetExceeded(
+            f"{method} {url} ran {count} queries, more than the budget of {max_queries}"
+        )
+    return r
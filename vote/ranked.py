@@ -0,0 +1,210 @@
+"""
+Ranked ballots, counted by instant-runoff (irv) or single transferable vote (stv).
+
+A ranked ballot is stored as its option ids, most preferred first, packed as
+little-endian uint32s. Counting loads every ballot of a question into one
+(ballots x ranks) matrix of candidate indices and runs each round as a few
+array operations over the whole matrix, so even tens of thousands of ballots
+take milliseconds per round.
+
+STV uses the Droop quota and the weighted inclusive Gregory method: when a
+candidate is elected, every ballot counting for them moves on to its next
+continuing preference, at its current weight times surplus / votes. IRV is
+the one seat case, except that the quota is a majority of the ballots still
+counting in each round. Of the candidates tied for fewest votes, the one
+with fewest votes in the earliest round where they differed is eliminated,
+and failing that the one listed first.
+"""
+from typing import Any, Dict, List, Sequence, Union
+
+import numpy
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from .models import *
+
+RANKED_METHODS = ["irv", "stv"]
+_PACKED = numpy.dtype("<u4")
+# Vote totals are fractional under STV, so comparisons allow for rounding
+_EPSILON = 1e-9
+
+
+def pack_ranking(option_ids: Sequence[int]) -> bytes:
+    return numpy.asarray(option_ids, dtype=_PACKED).tobytes()
+
+
+def unpack_ranking(data: bytes) -> List[int]:
+    return numpy.frombuffer(data, dtype=_PACKED).tolist()
+
+
+def load_ranking_matrix(
+    session: Union[Session, sqlalchemy.Connection],
+    question_id: int,
+    option_ids: Sequence[int],
+    batch_size: int = 10000,
+) -> numpy.ndarray:
+    """
+    Loads a question's ballots as a (ballots x longest ranking) matrix.
+
+    Entries are indices into option_ids, most preferred first, with rankings
+    shorter than the longest padded with len(option_ids).
+    """
+    result = session.execute(
+        sqlalchemy.select(RankedBallot.ranking)
+        .where(RankedBallot.question_id == question_id)
+        .execution_options(yield_per=batch_size)
+    )
+    packed = [row.ranking for row in result]
+    lengths = numpy.fromiter((len(p) // _PACKED.itemsize for p in packed), numpy.int64)
+    ranked = numpy.frombuffer(b"".join(packed), dtype=_PACKED)
+
+    candidates = numpy.asarray(option_ids, dtype=numpy.int64)
+    order = numpy.argsort(candidates)
+    positions = numpy.searchsorted(candidates, ranked, sorter=order)
+    positions = numpy.minimum(positions, len(candidates) - 1)
+    indices = order[positions]
+    if len(ranked) > 0 and not numpy.array_equal(candidates[indices], ranked):
+        raise ValueError(f"Question {question_id} has a ballot ranking another option")
+
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    matrix = numpy.full((len(lengths), width), len(candidates), dtype=numpy.int32)
+    rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    starts = numpy.cumsum(lengths) - lengths
+    matrix[rows, numpy.arange(len(ranked)) - numpy.repeat(starts, lengths)] = indices
+    return matrix
+
+
+def first_preferences(
+    session: Union[Session, sqlalchemy.Connection],
+    question_id: int,
+    option_ids: Sequence[int],
+) -> Dict[int, int]:
+    """Counts the ballots ranking each option first"""
+    matrix = load_ranking_matrix(session, question_id, option_ids)
+    counts = numpy.zeros(len(option_ids) + 1, dtype=numpy.int64)
+    if matrix.shape[0] > 0:
+        counts = numpy.bincount(matrix[:, 0], minlength=len(option_ids) + 1)
+    return {id: int(votes) for id, votes in zip(option_ids, counts)}
+
+
+def count_ranked(
+    matrix: numpy.ndarray, candidates: int, seats: int = 1, majority: bool = False
+) -> Dict[str, Any]:
+    """
+    Counts a ranking matrix (see load_ranking_matrix) round by round.
+
+    With majority, the quota in each round is a majority of the ballots
+    still counting (IRV); otherwise it is the Droop quota for seats (STV).
+    Returns candidate indices: {"winners", "rounds": [{"quota", "votes",
+    "exhausted", "elected", "eliminated"}]}, where votes has the total of
+    every candidate still in the count.
+    """
+    ballots = matrix.shape[0]
+    if ballots == 0:
+        return {"winners": [], "rounds": []}
+    weights = numpy.ones(ballots)
+    # The extra last entry is the padding index, which never continues
+    continuing = numpy.ones(candidates + 1, dtype=bool)
+    continuing[candidates] = False
+    droop = numpy.floor(ballots / (seats + 1)) + 1
+    winners: List[int] = []
+    history: List[numpy.ndarray] = []
+    rounds = []
+    while len(winners) < seats and continuing.any():
+        # Each ballot counts for its most preferred continuing candidate
+        counting = continuing[matrix]
+        first = counting.argmax(axis=1)
+        current = numpy.where(
+            counting.any(axis=1), matrix[numpy.arange(ballots), first], candidates
+        )
+        totals = numpy.bincount(current, weights=weights, minlength=candidates + 1)
+        votes = totals[:candidates]
+        history.append(votes)
+        hopeful = numpy.flatnonzero(continuing[:candidates])
+        if majority:
+            quota = numpy.floor(votes[hopeful].sum() / 2) + 1
+        else:
+            quota = droop
+
+        elected: List[int] = []
+        eliminated: List[int] = []
+        reached = hopeful[votes[hopeful] >= quota - _EPSILON]
+        if len(reached) > 0:
+            elected = sorted(reached.tolist(), key=lambda c: -votes[c])
+            elected = elected[: seats - len(winners)]
+            for c in elected:
+                # Transfer the surplus with every ballot that elected them
+                weights[current == c] *= (votes[c] - quota) / votes[c]
+        elif len(winners) + len(hopeful) <= seats:
+            elected = sorted(hopeful.tolist(), key=lambda c: -votes[c])
+        else:
+            eliminated = [_lowest(hopeful, history)]
+        continuing[elected] = False
+        continuing[eliminated] = False
+        winners += elected
+        rounds.append(
+            {
+                "quota": float(quota),
+                "votes": {int(c): float(votes[c]) for c in hopeful},
+                "exhausted": float(totals[candidates]),
+                "elected": elected,
+                "eliminated": eliminated,
+            }
+        )
+    return {"winners": winners, "rounds": rounds}
+
+
+def _lowest(hopeful: numpy.ndarray, history: List[numpy.ndarray]) -> int:
+    votes = history[-1]
+    tied = hopeful[votes[hopeful] <= votes[hopeful].min() + _EPSILON]
+    for earlier in history:
+        if len(tied) == 1:
+            break
+        tied = tied[earlier[tied] <= earlier[tied].min() + _EPSILON]
+    return int(tied[0])
+
+
+def count_question(
+    session: Union[Session, sqlalchemy.Connection], question: Dict
+) -> Dict[str, Any]:
+    """
+    Counts a ranked question, given as {"id", "method", "seats", "options": [{"id", "name"}]}.
+
+    Returns {"method", "seats", "ballots", "winners", "rounds"}, with
+    candidates given as {"id", "name"} and round totals as {"id", "name", "votes"}.
+    """
+    options = question["options"]
+    matrix = load_ranking_matrix(session, question["id"], [o["id"] for o in options])
+    seats = question["seats"] if question["method"] == "stv" else 1
+    count = count_ranked(
+        matrix, len(options), seats=seats, majority=question["method"] == "irv"
+    )
+
+    def option(c: int) -> Dict:
+        return {"id": options[c]["id"], "name": options[c]["name"]}
+
+    return {
+        "method": question["method"],
+        "seats": seats,
+        "ballots": matrix.shape[0],
+        "winners": [option(c) for c in count["winners"]],
+        "rounds": [
+            {
+                "quota": _round(r["quota"]),
+                "votes": [
+                    {**option(c), "votes": _round(votes)}
+                    for c, votes in sorted(r["votes"].items(), key=lambda i: -i[1])
+                ],
+                "exhausted": _round(r["exhausted"]),
+                "elected": [option(c) for c in r["elected"]],
+                "eliminated": [option(c) for c in r["eliminated"]],
+            }
+            for r in count["rounds"]
+        ],
+    }
+
+
+def _round(votes: float) -> Union[int, float]:
+    # Whole numbers are shown as such; transferred votes to four places
+    votes = round(votes, 4)
+    return int(votes) if votes.is_integer() else votes
@@ -0,0 +1,98 @@
+"""
+Token bucket rate limiting shared by every worker process.
+
+The buckets live in a small file that each worker maps into memory, so a
+check is a hash, a file lock and a few bytes read and written, with no
+database or network involved. The file is a fixed size hash table: when it
+fills up, the buckets that have gone longest without a request are reused,
+which at worst lets a forgotten key start again with a full bucket.
+"""
+import contextlib
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Optional
+
+# Key hash (0 for an empty slot), tokens left, time of the last update
+_SLOT = struct.Struct("<Qdd")
+# Slots checked for a key before reusing the stalest of them
+_PROBES = 8
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by strings, stored in the file at path.
+
+    Every process that opens the same path shares the same buckets. Each key
+    holds at most burst tokens and regains one every interval seconds.
+    """
+
+    def __init__(self, path: str, slots: int = 4096):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * _SLOT.size
+        with self._locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            size = os.fstat(self._fd).st_size
+        self._slots = size // _SLOT.size
+        self._map = mmap.mmap(self._fd, self._slots * _SLOT.size)
+        # POSIX file locks only exclude other processes
+        self._thread_lock = threading.Lock()
+
+    def take(
+        self, key: str, burst: int, interval: float, now: Optional[float] = None
+    ) -> float:
+        """Takes a token for key. Returns 0 if there was one, otherwise the seconds until there is."""
+        if now is None:
+            now = time.time()
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        key_hash = int.from_bytes(digest, "little") or 1
+        start = key_hash % self._slots
+        with self._thread_lock, self._locked():
+            slot = None
+            stalest = None
+            stalest_updated = math.inf
+            for probe in range(_PROBES):
+                index = (start + probe) % self._slots
+                stored_hash, tokens, updated = _SLOT.unpack_from(
+                    self._map, index * _SLOT.size
+                )
+                if stored_hash == key_hash:
+                    slot = index
+                    break
+                if stored_hash == 0:
+                    stalest = index
+                    break
+                if updated < stalest_updated:
+                    stalest, stalest_updated = index, updated
+            if slot is None:
+                slot, tokens = stalest, float(burst)
+            else:
+                # The clock may have been set back; never refill for negative time
+                tokens = min(burst, tokens + max(now - updated, 0) / interval)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) * interval
+            _SLOT.pack_into(self._map, slot * _SLOT.size, key_hash, tokens, now)
+        return wait
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # lockf rather than flock: flock locks belong to the open file, which
+        # workers forked after the limiter was created would all share
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
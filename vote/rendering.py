@@ -0,0 +1,27 @@
+"""
+Jinja environment shared by the web server and the CLI.
+"""
+import hashlib
+
+import jinja2
+
+# Use this isntead of Jinja2Templates with fastapi because we need to send templated emails
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    autoescape=jinja2.select_autoescape(["html"]),
+    # Pages' ETags assume templates do not change while the process runs
+    auto_reload=False,
+)
+
+
+def _digest_templates() -> str:
+    digest = hashlib.sha256()
+    for name in sorted(templates.list_templates()):
+        source, _, _ = templates.loader.get_source(templates, name)
+        digest.update(name.encode("utf-8"))
+        digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Changes whenever a template does, so that page ETags do too
+TEMPLATES_DIGEST = _digest_templates()
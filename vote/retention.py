@@ -0,0 +1,127 @@
+"""
+Deletes expired login sessions and tokens, and returns the freed space.
+
+Everything happens in small steps so that the ballot writer never waits long
+for the write lock: rows are deleted batch_size at a time, each batch in its
+own short transaction with a pause before the next, and free pages are
+released a few hundred at a time with incremental vacuum (available on
+databases created with auto_vacuum = INCREMENTAL, see enable_incremental_vacuum).
+A passive WAL checkpoint at the end copies committed pages back into the
+database without waiting on readers or writers.
+"""
+import datetime
+import time
+from typing import Dict
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from .models import *
+
+_INCREMENTAL = 2
+
+
+def delete_in_batches(
+    engine: sqlalchemy.Engine,
+    table: sqlalchemy.Table,
+    condition: sqlalchemy.ColumnElement[bool],
+    batch_size: int = 1000,
+    pause: float = 0.05,
+) -> int:
+    """Deletes the rows of table matching condition, one short transaction per batch. Returns the count."""
+    batch = sqlalchemy.select(table.c.id).where(condition).limit(batch_size)
+    count = 0
+    while True:
+        with Session(engine) as session:
+            session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            deleted = session.execute(
+                sqlalchemy.delete(table).where(table.c.id.in_(batch.scalar_subquery()))
+            ).rowcount
+            session.commit()
+        count += deleted
+        if deleted < batch_size:
+            return count
+        time.sleep(pause)
+
+
+def vacuum_incrementally(
+    engine: sqlalchemy.Engine, pages_per_step: int = 500, pause: float = 0.05
+) -> int:
+    """Returns free pages to the filesystem a step at a time. Returns how many were released."""
+    released = 0
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != _INCREMENTAL:
+            return 0
+        while True:
+            free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            if free == 0:
+                return released
+            # The pragma frees one page per step, and execute() only steps a
+            # statement once, so it runs as a script
+            cursor.executescript(
+                "BEGIN IMMEDIATE;"
+                f"PRAGMA incremental_vacuum({min(free, pages_per_step)});"
+                "COMMIT;"
+            )
+            released += free - cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(pause)
+    finally:
+        connection.close()
+
+
+def checkpoint(engine: sqlalchemy.Engine) -> int:
+    """Runs a passive WAL checkpoint and returns the number of pages copied back"""
+    with engine.connect() as connection:
+        busy, log, checkpointed = connection.exec_driver_sql(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).one()
+    # -1 when the database is not in WAL mode
+    return max(checkpointed, 0)
+
+
+def enable_incremental_vacuum(engine: sqlalchemy.Engine):
+    """Switches an existing database to incremental vacuum. Rewrites the whole file while holding the write lock."""
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+
+def run_retention(
+    engine: sqlalchemy.Engine,
+    expired_before: datetime.datetime,
+    batch_size: int = 1000,
+    vacuum_pages: int = 500,
+    pause: float = 0.05,
+) -> Dict[str, int]:
+    """Deletes sessions, tokens and abandoned emails that expired before expired_before, then compacts"""
+    counts = {
+        "sessions": delete_in_batches(
+            engine,
+            BrowserSession.__table__,
+            BrowserSession.expiration < expired_before,
+            batch_size,
+            pause,
+        ),
+        # Used tokens are expired by backdating them
+        "login_tokens": delete_in_batches(
+            engine,
+            LoginToken.__table__,
+            LoginToken.expiration < expired_before,
+            batch_size,
+            pause,
+        ),
+        # Emails the mailer gave up on
+        "outbox_emails": delete_in_batches(
+            engine,
+            OutboxEmail.__table__,
+            (OutboxEmail.next_attempt_at == None)
+            & (OutboxEmail.created_at < expired_before),
+            batch_size,
+            pause,
+        ),
+    }
+    counts["pages_released"] = vacuum_incrementally(engine, vacuum_pages, pause)
+    counts["pages_checkpointed"] = checkpoint(engine)
+    return counts
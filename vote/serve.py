@@ -1,18 +1,18 @@
+import asyncio
 import base64
-import email
-import email.headerregistry
-import email.message
+import contextlib
+import hashlib
 import hmac
 import json
+import logging
+import math
 import secrets
-import smtplib
-import ssl
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
-import jinja2
-import requests
 import sqlalchemy
+import sqlalchemy.dialects.sqlite
 import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
 from fastapi import (
     BackgroundTasks,
     Cookie,
@@ -23,52 +23,121 @@ from fastapi import (
     Request,
     Response,
 )
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseSettings
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 
+from . import profiling
+from .assets import StaticAssets
+from .ballot import CompiledBallot
+from .broadcast import Broadcaster
+from .cache import SNAPSHOTS, STRUCTURE, TALLIES, DataCache
+from .config import settings
+from .database import create_async_engine, create_engine
+from .metrics import (
+    LOGIN_REQUESTS_LIMITED,
+    MetricsMiddleware,
+    instrument_engine,
+    render,
+)
+from .migrations import migrate
 from .models import *
-
-# Setup database
-db_engine = sqlalchemy.create_engine(
-    "sqlite:////var/lib/vote-daemon/elections.db", echo=False
+from .profiling import QueryTraceMiddleware
+from .ratelimit import RateLimiter
+from .rendering import TEMPLATES_DIGEST, templates
+from .snapshots import (
+    FINALIZE_DELAY,
+    finalize_elections,
+    is_current,
+    load_snapshots,
+    render_card,
+    results_from_tallies,
 )
-OrmBase.metadata.create_all(db_engine)
-
-# Setup website templating
-# Use this isntead of Jinja2Templates with fastapi because we need to send templated emails
-templates = jinja2.Environment(
-    loader=jinja2.FileSystemLoader("templates"),
-    autoescape=jinja2.select_autoescape(["html"]),
+from .tally import get_tallies, get_voted_elections
+from .voteids import VoteIdAllocator
+from .writer import BallotResult, BallotWriter
+
+# Setup database. Request handlers use the async engine; the sync engine is
+# kept for schema setup, cache polling and the ballot writer thread.
+db_engine = create_engine(settings)
+migrate(db_engine)
+async_db_engine = create_async_engine(settings)
+async_session = sqlalchemy.ext.asyncio.async_sessionmaker(
+    async_db_engine, expire_on_commit=False
+)
+if settings.database_replica_url != "":
+    # Cached page data is loaded from the replica, and the cache polls the
+    # replica for changes, so entries are never newer than their data.
+    # Sessions, per-voter state and all writes stay on the primary.
+    replica_engine = create_engine(settings, replica=True)
+    async_replica_engine = create_async_engine(settings, replica=True)
+    replica_session = sqlalchemy.ext.asyncio.async_sessionmaker(
+        async_replica_engine, expire_on_commit=False
+    )
+else:
+    replica_engine = db_engine
+    async_replica_engine = async_db_engine
+    replica_session = async_session
+for engine in {
+    db_engine,
+    async_db_engine.sync_engine,
+    replica_engine,
+    async_replica_engine.sync_engine,
+}:
+    instrument_engine(engine)
+    profiling.instrument_engine(engine)
+if settings.query_trace_header or settings.query_trace_all:
+    logging.basicConfig()
+    profiling.logger.setLevel(logging.INFO)
+data_cache = DataCache(replica_engine)
+ballot_writer = BallotWriter(
+    db_engine,
+    VoteIdAllocator.from_settings(settings),
+    batch_size=settings.ballot_batch_size,
 )
 
+login_limiter = RateLimiter(settings.rate_limit_path)
 
-class Settings(BaseSettings):
-    csrf_key: str = ""
-    base_url: str = "http://localhost:9000"
-    smtp_username: str = ""
-    smtp_password: str = ""
-
-    class Config:
-        secrets_dir = "/var/lib/vote-daemon/secrets"
+# Static files are fingerprinted and compressed once, at startup
+static_assets = StaticAssets("static")
+templates.globals["static_url"] = static_assets.url
 
 
-settings = Settings()
+@contextlib.asynccontextmanager
+async def open_sessions():
+    """Yields a primary session and one for cached data, which is the same session without a replica"""
+    async with async_session() as session:
+        if replica_session is async_session:
+            yield session, session
+        else:
+            async with replica_session() as read_session:
+                yield session, read_session
 
 
-def get_login_status(cookie: Optional[str], session: sqlalchemy.orm.Session) -> Dict:
+async def get_login_status(
+    cookie: Optional[str], session: sqlalchemy.ext.asyncio.AsyncSession
+) -> Dict:
+    if cookie is None:
+        return {"logged_in": False}
     now = datetime.datetime.now()
     stmt = (
         sqlalchemy.select(BrowserSession)
         .where(BrowserSession.cookie == cookie)
         .where(BrowserSession.expiration > now)
     )
-    browser_session = session.scalar(stmt)
+    browser_session = await session.scalar(stmt)
     if browser_session is None:
         return {"logged_in": False}
-    # Bump the expiration
-    browser_session.expiration = now + datetime.timedelta(hours=1)
-    session.commit()
+    # Bump the expiration, skipping the write if it was bumped recently
+    lifetime = datetime.timedelta(minutes=settings.session_lifetime_minutes)
+    if browser_session.expiration - now <= lifetime * (
+        1 - settings.session_refresh_fraction
+    ):
+        browser_session.expiration = now + lifetime
+        await session.commit()
     return {"logged_in": True, "kerberos": browser_session.kerberos}
 
 
@@ -95,200 +164,313 @@ def validate_csrf(token_str: str, signed_str: str) -> bool:
         return False
 
 
-def is_grad_student(kerberos: str) -> bool:
-    """Checks that the given kerberos is a grad student by checking tlepeopledir"""
-    with sqlalchemy.orm.Session(db_engine) as session:
-        # First, check the cache
-        stmt = sqlalchemy.select(VoterEligibility).where(
-            VoterEligibility.kerberos == kerberos
-        )
-        if session.scalar(stmt) is not None:
-            return True
-        # If not, request from the directory
-        r = requests.get(
-            f"https://tlepeopledir.mit.edu/q/{kerberos}", params={"_format": "json"}
+def load_visible_elections(session: sqlalchemy.orm.Session) -> Dict[int, Dict]:
+    """Loads the structure of every visible election as plain dicts that can be cached"""
+    stmt = (
+        sqlalchemy.select(Election)
+        .where(Election.visible == True)
+        .options(
+            sqlalchemy.orm.selectinload(Election.questions).selectinload(
+                Question.options
+            )
         )
-        lookup = r.json()
-        if "result" in lookup:
-            for result in lookup["result"]:
-                if (
-                    "email_id" in result
-                    and result["email_id"] == kerberos
-                    and "email_domain" in result
-                    and result["email_domain"] == "mit.edu"
-                    and "student_year" in result
-                    and result["student_year"] == "G"
-                ):
-                    session.add(VoterEligibility(kerberos=kerberos))
-                    session.commit()
-                    return True
-    return False
-
-
-def send_login_email(kerberos: str):
+    )
+    return {
+        election.id: {
+            "id": election.id,
+            "name": election.name,
+            "open": election.open_timestamp,
+            "close": election.close_timestamp,
+            "questions": [
+                {
+                    "id": question.id,
+                    "name": question.name,
+                    "method": question.method,
+                    "seats": question.seats,
+                    "options": [
+                        {"name": option.name, "id": option.id}
+                        for option in question.options
+                    ],
+                }
+                for question in election.questions
+            ],
+        }
+        for election in session.scalars(stmt)
+    }
+
+
+async def get_visible_elections(
+    session: sqlalchemy.ext.asyncio.AsyncSession,
+) -> Dict[int, Dict]:
+    return await data_cache.get(
+        "visible_elections",
+        (STRUCTURE,),
+        lambda: session.run_sync(load_visible_elections),
+    )
+
+
+async def get_compiled_ballots(
+    session: sqlalchemy.ext.asyncio.AsyncSession,
+) -> Dict[int, CompiledBallot]:
+    async def compile_ballots():
+        return {
+            election_id: CompiledBallot.compile(election)
+            for election_id, election in (await get_visible_elections(session)).items()
+        }
+
+    return await data_cache.get("compiled_ballots", (STRUCTURE,), compile_ballots)
+
+
+def make_etag(*parts) -> str:
+    """Builds an ETag from the values that a page is rendered from"""
+    digest = hashlib.sha256(
+        repr((TEMPLATES_DIGEST, static_assets.digest, parts)).encode("utf-8")
+    ).digest()
+    return '"' + base64.urlsafe_b64encode(digest[:18]).decode("ascii") + '"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    # Pages depend on the session cookie, and must be revalidated on every view
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Cookie"}
+
+
+async def get_snapshots(
+    session: sqlalchemy.ext.asyncio.AsyncSession,
+    read_session: sqlalchemy.ext.asyncio.AsyncSession,
+    elections: Dict[int, Dict],
+    now: datetime.datetime,
+) -> Dict[int, Dict]:
+    """Returns the snapshots of closed elections, taking any that are missing"""
+    snapshots = await data_cache.get(
+        "snapshots", (SNAPSHOTS,), lambda: read_session.run_sync(load_snapshots)
+    )
+    unfinalized = [
+        election["id"]
+        for election in elections.values()
+        if election["close"] + FINALIZE_DELAY < now
+        and not is_current(snapshots.get(election["id"]), election)
+    ]
+    if len(unfinalized) > 0:
+        await session.run_sync(finalize_elections, unfinalized)
+        await session.commit()
+        # Read back from the primary, which a replica may not have caught up with
+        snapshots = await session.run_sync(load_snapshots)
+    return snapshots
+
+
+def live_election_ids(elections: Dict[int, Dict], snapshots: Dict[int, Dict]):
+    """Returns the ids of the elections that are not served from a snapshot"""
+    return tuple(
+        election["id"]
+        for election in elections.values()
+        if not is_current(snapshots.get(election["id"]), election)
+    )
+
+
+async def get_live_tallies(
+    session: sqlalchemy.ext.asyncio.AsyncSession, live_ids: Tuple[int, ...]
+) -> Dict[int, int]:
+    return await data_cache.get(
+        ("tallies", live_ids),
+        (STRUCTURE, TALLIES),
+        lambda: session.run_sync(get_tallies, live_ids),
+    )
+
+
+async def load_public_results(
+    session: sqlalchemy.ext.asyncio.AsyncSession,
+    read_session: sqlalchemy.ext.asyncio.AsyncSession,
+    election_ids: Iterable[int],
+) -> Dict[int, Dict]:
+    """
+    Returns what the given elections show publicly: turnout while open, and full results once closed.
+
+    Elections that are not visible or not open yet are left out.
+    """
     now = datetime.datetime.now()
-    # Check for grad student status
-    if not is_grad_student(kerberos):
-        return
-    with sqlalchemy.orm.Session(db_engine) as session:
-        # Check that an existing token does not exist.
-        token = LoginToken(
-            kerberos=kerberos,
-            token=secrets.token_urlsafe(64),
-            expiration=now + datetime.timedelta(minutes=10),
-        )
-        session.add(token)
+    elections = await get_visible_elections(read_session)
+    snapshots = await get_snapshots(session, read_session, elections, now)
+    live_ids = live_election_ids(elections, snapshots)
+    tallies = await get_live_tallies(read_session, live_ids)
+    results = {}
+    for election_id in election_ids:
+        election = elections.get(election_id)
+        if election is None or election["open"] >= now:
+            continue
+        if election_id not in live_ids:
+            election_results = {
+                **snapshots[election_id]["results"],
+                "status": "closed",
+                "final": True,
+            }
+        else:
+            election_results = results_from_tallies(election, tallies)
+            if election["close"] < now:
+                election_results.update({"status": "closed", "final": False})
+            else:
+                # Vote counts are kept secret until the election closes
+                del election_results["questions"]
+                election_results["status"] = "open"
+        election_results["close"] = election["close"].isoformat()
+        results[election_id] = election_results
+    return results
 
-        msg = email.message.EmailMessage()
-        msg["Subject"] = "Voting login link"
-        msg["From"] = email.headerregistry.Address(
-            display_name="Grad voting system (uenotformit)",
-            addr_spec="uenotformit-contributors@mit.edu",
-        )
-        msg["To"] = email.headerregistry.Address(addr_spec=f"{kerberos}@mit.edu")
-        msg.set_content(
-            templates.get_template("token_email.txt").render(
-                {"url": f"{settings.base_url}/login/{token.token}"}
-            )
-        )
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP("outgoing.mit.edu", port=587) as s:
-            s.starttls(context=context)
-            s.login(settings.smtp_username, settings.smtp_password)
-            s.send_message(msg)
+async def load_broadcast_results(election_ids: Iterable[int]) -> Dict[int, Dict]:
+    async with open_sessions() as (session, read_session):
+        return await load_public_results(session, read_session, election_ids)
+
 
-        session.commit()
+results_broadcaster = Broadcaster(
+    load_broadcast_results, interval=settings.results_poll_interval_s
+)
+# Comment lines sent on idle streams, so that proxies do not close them
+STREAM_KEEPALIVE_S = 15
 
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(
+    QueryTraceMiddleware,
+    header_enabled=settings.query_trace_header,
+    trace_all=settings.query_trace_all,
+)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", static_assets, name="static")
 
 
 @app.get("/", response_class=HTMLResponse)
-def root(vote_session: Optional[str] = Cookie(default=None)):
+async def root(request: Request, vote_session: Optional[str] = Cookie(default=None)):
     now = datetime.datetime.now()
-    with sqlalchemy.orm.Session(db_engine) as session:
+    # Read before loading anything, so the ETag can only be older than the page
+    versions = data_cache.versions()
+    async with open_sessions() as (session, read_session):
         template_vals: Dict = {
             **{"open_elections": [], "closed_elections": []},
-            **get_login_status(vote_session, session),
+            **await get_login_status(vote_session, session),
         }
-        print(template_vals)
+        elections = await get_visible_elections(read_session)
 
-        stmt = sqlalchemy.select(Election).where(Election.visible == True)
-        elections = session.scalars(stmt)
-        for election in elections:
-            if template_vals["logged_in"] == False:
-                has_voted = False
-            else:
-                vote_stmt = (
-                    sqlalchemy.select(Voter)
-                    .where(Voter.election_id == election.id)
-                    .where(Voter.kerberos == template_vals["kerberos"])
+        # Closed elections are served from their snapshots
+        snapshots = await get_snapshots(session, read_session, elections, now)
+        live_ids = live_election_ids(elections, snapshots)
+        if template_vals["logged_in"] == False:
+            voted_elections = set()
+        else:
+            voted_elections = await session.run_sync(
+                get_voted_elections, template_vals["kerberos"], live_ids
+            )
+
+        etag = make_etag(
+            versions.get(STRUCTURE),
+            versions.get(SNAPSHOTS),
+            versions.get(TALLIES) if len(live_ids) > 0 else None,
+            template_vals.get("kerberos"),
+            sorted(voted_elections),
+            # Elections move between sections as time passes
+            [
+                (
+                    election["id"],
+                    election["open"] < now,
+                    election["close"] < now,
+                    election["id"] not in live_ids,
                 )
-                has_voted = session.scalar(vote_stmt) is not None
-            election_dict = {
-                "id": election.id,
-                "name": election.name,
-                "close": election.close_timestamp,
-                "has_voted": has_voted,
-                "questions": [
-                    {
-                        "name": question.name,
-                        "options": [
-                            {
-                                "name": option.name,
-                                "votes": session.query(Vote)
-                                .filter(Vote.question_option == option.id)
-                                .count(),
-                            }
-                            for option in question.options
-                        ],
-                    }
-                    for question in election.questions
-                ],
-            }
-            if len(election_dict["questions"]) == 0:
-                election_dict["total_votes"] = 0
-            else:
-                election_dict["total_votes"] = sum(
-                    o["votes"] for o in election_dict["questions"][0]["options"]
+                for election in elections.values()
+            ],
+        )
+        if is_not_modified(request, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+
+        tallies = await get_live_tallies(read_session, live_ids)
+        for election in elections.values():
+            if election["id"] not in live_ids:
+                template_vals["closed_elections"].append(
+                    snapshots[election["id"]]["html"]
                 )
-
-            if election.close_timestamp < now:
-                template_vals["closed_elections"].append(election_dict)
-            elif election.open_timestamp < now:
-                # Compute votes for each option
+            elif election["close"] < now:
+                # Closed too recently to finalize
+                template_vals["closed_elections"].append(
+                    render_card(results_from_tallies(election, tallies))
+                )
+            elif election["open"] < now:
+                election_dict = results_from_tallies(election, tallies)
+                election_dict["has_voted"] = election["id"] in voted_elections
                 template_vals["open_elections"].append(election_dict)
 
-        return templates.get_template("main.html").render(template_vals)
+    return HTMLResponse(
+        templates.get_template("main.html").render(template_vals),
+        headers=cache_headers(etag),
+    )
 
 
 @app.get("/vote/{election_id}", response_class=HTMLResponse)
-def render_vote_page(
-    response: Response,
+async def render_vote_page(
+    request: Request,
     election_id: int,
     vote_session: Optional[str] = Cookie(default=None),
+    vote_csrf: Optional[str] = Cookie(default=None),
 ):
     now = datetime.datetime.now()
-    csrf = generate_csrf()
-    response.set_cookie(
-        key="vote_csrf", value=csrf[1], secure=True, httponly=True, samesite="strict"
-    )
-    with sqlalchemy.orm.Session(db_engine) as session:
-        template_dict = {**{"csrf": csrf[0]}, **get_login_status(vote_session, session)}
+    versions = data_cache.versions()
+    async with open_sessions() as (session, read_session):
+        template_dict = await get_login_status(vote_session, session)
+        election = (await get_visible_elections(read_session)).get(election_id)
         if template_dict["logged_in"] == False:
             template_dict["alert"] = "You must be logged in to vote!"
             template_dict["alert_type"] = "danger"
-            return templates.get_template("vote.html").render(template_dict)
         # Check if the election exists
-        stmt = (
-            sqlalchemy.select(Election)
-            .where(Election.id == election_id)
-            .where(Election.visible == True)
-            .where(Election.open_timestamp < now)
-        )
-        election = session.scalar(stmt)
-        if election is None:
+        elif election is None or election["open"] >= now:
             template_dict["alert"] = "Invalid election ID"
             template_dict["alert_type"] = "danger"
-            return templates.get_template("vote.html").render(template_dict)
-        if election.close_timestamp < now:
+        elif election["close"] < now:
             template_dict["alert"] = "This election has closed"
             template_dict["alert_type"] = "info"
-            return templates.get_template("vote.html").render(template_dict)
+        else:
+            # Check if the voter has already voted
+            stmt = (
+                sqlalchemy.select(Voter)
+                .where(Voter.election_id == election_id)
+                .where(Voter.kerberos == template_dict["kerberos"])
+            )
+            voter = await session.scalar(stmt)
+            if voter is not None:
+                template_dict["alert"] = "You have successfully voted."
+                template_dict["alert_type"] = "success"
+            else:
+                # Otherwise, return the questions
+                template_dict["election"] = election
+
+    # The page embeds the CSRF token paired with the vote_csrf cookie, so a
+    # cached copy is only still usable while the browser has the same cookie
+    state = (
+        versions.get(STRUCTURE),
+        election_id,
+        template_dict.get("kerberos"),
+        template_dict.get("alert"),
+    )
+    if vote_csrf is not None:
+        etag = make_etag(*state, vote_csrf)
+        if is_not_modified(request, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
 
-        # Check if the voter has already voted
-        stmt = (
-            sqlalchemy.select(Voter)
-            .where(Voter.election_id == election_id)
-            .where(Voter.kerberos == template_dict["kerberos"])
-        )
-        voter = session.scalar(stmt)
-        if voter is not None:
-            template_dict["alert"] = "You have successfully voted."
-            template_dict["alert_type"] = "success"
-            return templates.get_template("vote.html").render(template_dict)
-
-        # Otherwise, return the questions
-        template_dict["election"] = {
-            "id": election.id,
-            "name": election.name,
-            "close": election.close_timestamp,
-            "questions": [
-                {
-                    "id": question.id,
-                    "name": question.name,
-                    "options": [
-                        {"name": option.name, "id": option.id}
-                        for option in question.options
-                    ],
-                }
-                for question in election.questions
-            ],
-        }
-    return templates.get_template("vote.html").render(template_dict)
+    csrf = generate_csrf()
+    template_dict["csrf"] = csrf[0]
+    response = HTMLResponse(
+        templates.get_template("vote.html").render(template_dict),
+        headers=cache_headers(make_etag(*state, csrf[1])),
+    )
+    response.set_cookie(
+        key="vote_csrf", value=csrf[1], secure=True, httponly=True, samesite="strict"
+    )
+    return response
 
 
 async def process_vote_body(request: Request) -> Dict[str, str]:
@@ -318,72 +500,184 @@ async def vote(
         return HTMLResponse(status_code=401)
 
     try:
-        with sqlalchemy.orm.Session(db_engine) as session:
+        async with open_sessions() as (session, read_session):
             # Check login status
-            login_status = get_login_status(vote_session, session)
+            login_status = await get_login_status(vote_session, session)
             if login_status["logged_in"] == False:
                 return response
             # Check that the election exists (and is open)
-            stmt = (
-                sqlalchemy.select(Election)
-                .where(Election.id == election_id)
-                .where(Election.visible == True)
-                .where(Election.open_timestamp < now)
-            )
-            election = session.scalar(stmt)
-            if election is None or election.close_timestamp < now:
+            election = (await get_visible_elections(read_session)).get(election_id)
+            if election is None or election["open"] >= now or election["close"] < now:
                 return response
-            session.rollback()
-            with session.begin():
-                # This add will fail if the voter has already voted, auto-aborting
-                voter = Voter(
-                    kerberos=login_status["kerberos"], election_id=election_id
-                )
-                session.add(voter)
-
-                submitted_questions = []
-                for k, v in votes.items():
-                    if k.startswith("question-"):
-                        vote_question = int(k[9:])
-                        vote = int(v)
-                        stmt = sqlalchemy.select(QuestionOption).where(
-                            QuestionOption.id == vote
-                        )
-                        question_option = session.scalar(stmt)
-                        # Validate that the vote is actually for this question and this election
-                        if question_option is None:
-                            raise RuntimeError("Invalid question option for vote")
-                        if question_option.question.id != vote_question:
-                            raise RuntimeError("Invalid question for this option")
-                        if question_option.question.election_id != election_id:
-                            raise RuntimeError("Invalid option for this election")
-
-                        submitted_questions.append(vote_question)
-                        session.add(Vote(question_option=vote))
-                election_questions = session.scalars(
-                    sqlalchemy.select(Question).where(
-                        Question.election_id == election_id
-                    )
-                ).all()
-                if set(submitted_questions) != {q.id for q in election_questions}:
-                    raise RuntimeError("Did not submit a complete ballot!")
-    except sqlalchemy.exc.SQLAlchemyError:
-        pass
+            # Validate the ballot in memory before touching the database
+            # A structure change can land between the two cache loads
+            compiled = (await get_compiled_ballots(read_session)).get(election_id)
+            if compiled is None:
+                return response
+            ballot = compiled.validate(votes)
     except RuntimeError:
-        pass
+        return response
+
+    # Voters that have already voted are shown that on the refreshed page
+    try:
+        result = await asyncio.wrap_future(
+            ballot_writer.submit(
+                login_status["kerberos"],
+                election_id,
+                ballot.option_ids,
+                ballot.rankings,
+            )
+        )
+    except sqlalchemy.exc.SQLAlchemyError:
+        template_dict = {
+            **login_status,
+            "alert": "Your ballot could not be recorded. Please go back and try again.",
+            "alert_type": "danger",
+        }
+        return HTMLResponse(
+            templates.get_template("vote.html").render(template_dict),
+            status_code=503,
+        )
+    if result == BallotResult.CLOSED:
+        template_dict = {
+            **login_status,
+            "alert": "The election closed before your ballot could be recorded.",
+            "alert_type": "danger",
+        }
+        return HTMLResponse(
+            templates.get_template("vote.html").render(template_dict),
+            status_code=409,
+        )
     # Refresh page
     return response
 
 
+@app.get("/elections/{election_id}/results")
+async def election_results(election_id: int):
+    async with open_sessions() as (session, read_session):
+        results = await load_public_results(session, read_session, [election_id])
+    if election_id not in results:
+        raise HTTPException(status_code=404, detail="Invalid election ID")
+    return results[election_id]
+
+
+@app.get("/elections/{election_id}/stream")
+async def stream_election_results(election_id: int):
+    async with open_sessions() as (session, read_session):
+        results = await load_public_results(session, read_session, [election_id])
+        if election_id not in results:
+            raise HTTPException(status_code=404, detail="Invalid election ID")
+
+    async def events():
+        with results_broadcaster.subscribe(election_id) as updates:
+            while True:
+                try:
+                    results = await asyncio.wait_for(updates.get(), STREAM_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if results is None:
+                    return
+                yield f"event: results\ndata: {json.dumps(results)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    content, content_type = render()
+    return Response(content, media_type=content_type)
+
+
+# Set once this worker's caches are filled
+is_warm = False
+
+
+def compile_templates():
+    for name in templates.list_templates():
+        templates.get_template(name)
+
+
+async def warm_up():
+    """Compiles the templates and fills the caches that the homepage and ballots are served from"""
+    global is_warm
+    compile_templates()
+    async with open_sessions() as (session, read_session):
+        elections = await get_visible_elections(read_session)
+        await get_compiled_ballots(read_session)
+        snapshots = await get_snapshots(
+            session, read_session, elections, datetime.datetime.now()
+        )
+        await get_live_tallies(read_session, live_election_ids(elections, snapshots))
+    is_warm = True
+
+
+def preload():
+    """Compiles the templates in the gunicorn master and closes its connections, which the workers must not share"""
+    # The async engines are left alone: their connections and first-connect
+    # locks must not exist before the fork, so workers fill the caches themselves
+    compile_templates()
+    data_cache.close()
+    db_engine.dispose()
+    replica_engine.dispose()
+
+
+def after_fork():
+    """Drops any pooled connections inherited from the gunicorn master without closing them"""
+    for engine in {
+        db_engine,
+        async_db_engine.sync_engine,
+        replica_engine,
+        async_replica_engine.sync_engine,
+    }:
+        engine.dispose(close=False)
+
+
+@app.on_event("startup")
+async def startup():
+    # Each worker fills its caches before accepting connections
+    if not is_warm:
+        await warm_up()
+
+
+@app.get("/ready")
+def ready():
+    """Readiness check for load balancers and deploy scripts"""
+    try:
+        # Also checks that the database can be read
+        data_cache.versions()
+    except Exception:
+        return JSONResponse({"ready": False}, status_code=503)
+    if not is_warm:
+        return JSONResponse({"ready": False}, status_code=503)
+    return {"ready": True}
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await results_broadcaster.close()
+    await asyncio.to_thread(ballot_writer.stop)
+    await async_db_engine.dispose()
+    if async_replica_engine is not async_db_engine:
+        await async_replica_engine.dispose()
+
+
 @app.get("/request_login", response_class=HTMLResponse)
-def render_login_page(
+async def render_login_page(
     response: Response,
     warning: Optional[str] = None,
     vote_session: Optional[str] = Cookie(default=None),
 ):
     csrf = generate_csrf()
-    with sqlalchemy.orm.Session(db_engine) as session:
-        template_dict = {**{"csrf": csrf[0]}, **get_login_status(vote_session, session)}
+    async with async_session() as session:
+        template_dict = {
+            **{"csrf": csrf[0]},
+            **await get_login_status(vote_session, session),
+        }
         if warning is not None:
             template_dict["alert_type"] = "warning"
             template_dict["alert"] = warning
@@ -397,31 +691,81 @@ def render_login_page(
         return templates.get_template("request_login.html").render(template_dict)
 
 
+def client_address(request: Request) -> str:
+    if request.client is None or request.client.host == "":
+        # Behind the reverse proxy on a unix socket; Caddy sets the header to
+        # the address it accepted the connection from
+        forwarded = request.headers.get("x-forwarded-for", "")
+        return forwarded.rsplit(",", 1)[-1].strip()
+    return request.client.host
+
+
 @app.post("/request_login", response_class=HTMLResponse)
-def check_response(
+async def check_response(
+    request: Request,
     response: Response,
-    background_tasks: BackgroundTasks,
     csrf: str = Form(),
     kerberos: str = Form(),
     vote_csrf: str = Cookie(),
 ):
     now = datetime.datetime.now()
+    # Rejects floods before any database work
+    wait = login_limiter.take(
+        "address " + client_address(request),
+        settings.login_address_burst,
+        settings.login_address_interval_s,
+    )
+    if wait > 0:
+        LOGIN_REQUESTS_LIMITED.labels("address").inc()
+        return HTMLResponse(
+            status_code=429, headers={"retry-after": str(math.ceil(wait))}
+        )
     if not validate_csrf(csrf, vote_csrf):
         return HTMLResponse(status_code=401)
     # Refresh page
     new_csrf = generate_csrf()
     template_dict = {"csrf": new_csrf[0]}
-    # Check that there isn't already a token
-    with sqlalchemy.orm.Session(db_engine) as session:
-        stmt = (
-            sqlalchemy.select(LoginToken)
-            .where(LoginToken.kerberos == kerberos)
-            .where(LoginToken.expiration > now)
+    response.set_cookie(
+        key="vote_csrf",
+        value=new_csrf[1],
+        secure=True,
+        httponly=True,
+        samesite="strict",
+    )
+    wait = login_limiter.take(
+        "kerberos " + kerberos.strip().lower(),
+        settings.login_kerberos_burst,
+        settings.login_kerberos_interval_s,
+    )
+    if wait > 0:
+        LOGIN_REQUESTS_LIMITED.labels("kerberos").inc()
+        response.status_code = 429
+        response.headers["retry-after"] = str(math.ceil(wait))
+        template_dict["alert_type"] = "warning"
+        template_dict[
+            "alert"
+        ] = "Too many login links were requested for this kerberos. Please try again later."
+        return templates.get_template("request_login.html").render(template_dict)
+    # Check that there isn't already a token, or an email on its way
+    async with async_session() as session:
+        stmt = sqlalchemy.select(
+            sqlalchemy.or_(
+                sqlalchemy.select(LoginToken.id)
+                .where(LoginToken.kerberos == kerberos)
+                .where(LoginToken.expiration > now)
+                .exists(),
+                sqlalchemy.select(OutboxEmail.id)
+                .where(OutboxEmail.kerberos == kerberos)
+                .where(OutboxEmail.next_attempt_at != None)
+                .exists(),
+            )
         )
-        tokens = session.scalars(stmt).all()
-        if len(tokens) == 0:
-            # Create new token and send an email using the background task
-            background_tasks.add_task(send_login_email, kerberos)
+        if not await session.scalar(stmt):
+            # The mailer process checks eligibility, creates the token and sends it
+            session.add(
+                OutboxEmail(kerberos=kerberos, created_at=now, next_attempt_at=now)
+            )
+            await session.commit()
             template_dict["alert_type"] = "info"
             template_dict[
                 "alert"
@@ -432,28 +776,21 @@ def check_response(
                 "alert"
             ] = "A login token was already generated! You can only request one login token every ten minutes"
 
-    response.set_cookie(
-        key="vote_csrf",
-        value=new_csrf[1],
-        secure=True,
-        httponly=True,
-        samesite="strict",
-    )
     return templates.get_template("request_login.html").render(template_dict)
 
 
 @app.get("/login/{token}")
-def login_with_token(response: Response, token: str):
+async def login_with_token(response: Response, token: str):
     now = datetime.datetime.now()
     response = RedirectResponse(url="/")
-    with sqlalchemy.orm.Session(db_engine) as session:
+    async with async_session() as session:
         # Check the token
         stmt = (
             sqlalchemy.select(LoginToken)
             .where(LoginToken.token == token)
             .where(LoginToken.expiration > now)
         )
-        login_token = session.scalar(stmt)
+        login_token = await session.scalar(stmt)
         if login_token is None:
             return RedirectResponse(
                 url="/request_login?warning=Invalid%20login%20token%2C%20it%20may%20have%20expired."
@@ -462,12 +799,13 @@ def login_with_token(response: Response, token: str):
         browser_session = BrowserSession(
             kerberos=login_token.kerberos,
             cookie=secrets.token_urlsafe(64),
-            expiration=now + datetime.timedelta(hours=1),
+            expiration=now
+            + datetime.timedelta(minutes=settings.session_lifetime_minutes),
         )
         session.add(browser_session)
         # Expire the login token
         login_token.expiration = datetime.datetime(1970, 1, 1, 0, 0, 0)
-        session.commit()
+        await session.commit()
         response.set_cookie(
             key="vote_session",
             value=browser_session.cookie,
@@ -479,14 +817,14 @@ def login_with_token(response: Response, token: str):
 
 
 @app.get("/logout")
-def logout_remove_session(vote_session: Optional[str] = Cookie(default=None)):
+async def logout_remove_session(vote_session: Optional[str] = Cookie(default=None)):
     if vote_session is not None:
-        with sqlalchemy.orm.Session(db_engine) as session:
+        async with async_session() as session:
             stmt = sqlalchemy.select(BrowserSession).where(
                 BrowserSession.cookie == vote_session
             )
-            browser_sessions = session.scalars(stmt).all()
+            browser_sessions = (await session.scalars(stmt)).all()
             for bs in browser_sessions:
-                session.delete(bs)
-            session.commit()
+                await session.delete(bs)
+            await session.commit()
     return RedirectResponse(url="/")
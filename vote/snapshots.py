@@ -0,0 +1,176 @@
+"""
+Frozen results for closed elections.
+
+Once an election has closed its votes can no longer change, so its results
+are counted once from the raw votes and stored along with its rendered
+homepage card. The homepage serves closed elections from these snapshots
+instead of recounting and re-rendering them on every request. A snapshot
+records the close time it was taken for, and is ignored (and retaken) if the
+election's close time changes.
+"""
+import datetime
+from typing import Dict, Iterable, Mapping, Optional
+
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .cache import SNAPSHOTS, bump_versions
+from .models import *
+from .ranked import count_question
+from .rendering import templates
+
+# Ballots accepted just before the close are committed by the writer thread a
+# moment later, so closed elections are only finalized automatically after this
+FINALIZE_DELAY = datetime.timedelta(seconds=30)
+
+
+def results_from_tallies(
+    election: Dict,
+    tallies: Mapping[int, int],
+    ranked: Optional[Mapping[int, Dict]] = None,
+) -> Dict:
+    """
+    Builds the results of an election dict (see load_visible_elections) from option tallies.
+
+    Ranked questions are tallied by first preference; their counts (see
+    vote.ranked.count_question), if given by question id, are added as "ranked".
+    """
+    questions = [
+        {
+            "name": question["name"],
+            "options": [
+                {"name": option["name"], "votes": tallies.get(option["id"], 0)}
+                for option in question["options"]
+            ],
+        }
+        for question in election["questions"]
+    ]
+    for question, question_results in zip(election["questions"], questions):
+        if ranked is not None and question["id"] in ranked:
+            question_results["ranked"] = ranked[question["id"]]
+    if len(questions) == 0:
+        total_votes = 0
+    else:
+        total_votes = sum(o["votes"] for o in questions[0]["options"])
+    return {
+        "id": election["id"],
+        "name": election["name"],
+        "close": election["close"],
+        "total_votes": total_votes,
+        "questions": questions,
+    }
+
+
+def render_card(results: Dict) -> str:
+    return templates.get_template("closed_election.html").render(election=results)
+
+
+def finalize_elections(session: Session, election_ids: Iterable[int]):
+    """Counts the votes of the given elections and stores their snapshots. The caller commits."""
+    election_ids = list(election_ids)
+    if len(election_ids) == 0:
+        return
+    elections = session.scalars(
+        sqlalchemy.select(Election)
+        .where(Election.id.in_(election_ids))
+        .options(
+            sqlalchemy.orm.selectinload(Election.questions).selectinload(
+                Question.options
+            )
+        )
+    ).all()
+    counts = dict(
+        session.execute(
+            sqlalchemy.select(Vote.question_option, sqlalchemy.func.count())
+            .join(QuestionOption, QuestionOption.id == Vote.question_option)
+            .join(Question, Question.id == QuestionOption.question_id)
+            .where(Question.election_id.in_(election_ids))
+            .group_by(Vote.question_option)
+        ).all()
+    )
+    now = datetime.datetime.now()
+    rows = []
+    for election in elections:
+        if election.close_timestamp >= now:
+            raise ValueError(f"Election {election.id} has not closed yet")
+        election_dict = {
+            "id": election.id,
+            "name": election.name,
+            "close": election.close_timestamp,
+            "questions": [
+                {
+                    "id": question.id,
+                    "name": question.name,
+                    "method": question.method,
+                    "seats": question.seats,
+                    "options": [
+                        {"name": option.name, "id": option.id}
+                        for option in question.options
+                    ],
+                }
+                for question in election.questions
+            ],
+        }
+        ranked = {
+            question["id"]: count_question(session, question)
+            for question in election_dict["questions"]
+            if question["method"] != "plurality"
+        }
+        for count in ranked.values():
+            # First preferences are the votes of the first round
+            if len(count["rounds"]) > 0:
+                counts.update(
+                    {o["id"]: o["votes"] for o in count["rounds"][0]["votes"]}
+                )
+        results = results_from_tallies(election_dict, counts, ranked)
+        rows.append(
+            {
+                "election_id": election.id,
+                "close_timestamp": election.close_timestamp,
+                "created_at": now,
+                # The close time is kept in its own column so results stay plain JSON
+                "results": {k: v for k, v in results.items() if k != "close"},
+                "html": render_card(results),
+            }
+        )
+    stmt = sqlalchemy.dialects.sqlite.insert(ElectionSnapshot).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ElectionSnapshot.election_id],
+        set_={
+            "close_timestamp": stmt.excluded.close_timestamp,
+            "created_at": stmt.excluded.created_at,
+            "results": stmt.excluded.results,
+            "html": stmt.excluded.html,
+        },
+    )
+    session.execute(stmt)
+    bump_versions(session, SNAPSHOTS)
+
+
+def discard_snapshot(session: Session, election_id: int):
+    """Deletes an election's snapshot, e.g. because its questions or close time changed"""
+    session.execute(
+        sqlalchemy.delete(ElectionSnapshot).where(
+            ElectionSnapshot.election_id == election_id
+        )
+    )
+    bump_versions(session, SNAPSHOTS)
+
+
+def load_snapshots(session: Session) -> Dict[int, Dict]:
+    """Returns election id -> {"close": close time it was taken for, "results", "html"}"""
+    stmt = sqlalchemy.select(ElectionSnapshot)
+    return {
+        snapshot.election_id: {
+            "close": snapshot.close_timestamp,
+            "results": snapshot.results,
+            "html": snapshot.html,
+        }
+        for snapshot in session.scalars(stmt)
+    }
+
+
+def is_current(snapshot: Optional[Dict], election: Dict) -> bool:
+    """Whether a snapshot (from load_snapshots) was taken for the election's current close time"""
+    return snapshot is not None and snapshot["close"] == election["close"]
@@ -0,0 +1,64 @@
+"""
+Vote tallies, kept as per-option counters that are updated alongside the votes.
+"""
+import collections
+from typing import Dict, Iterable, Set
+
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .cache import TALLIES, bump_versions
+from .models import *
+
+
+def record_votes(session: Session, option_ids: Iterable[int]):
+    """Increments the tally of each option. Call inside the transaction that adds the votes."""
+    counts = collections.Counter(option_ids)
+    if len(counts) == 0:
+        return
+    stmt = sqlalchemy.dialects.sqlite.insert(OptionTally).values(
+        [{"question_option_id": k, "votes": v} for k, v in counts.items()]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[OptionTally.question_option_id],
+        set_={"votes": OptionTally.votes + stmt.excluded.votes},
+    )
+    session.execute(stmt)
+    bump_versions(session, TALLIES)
+
+
+def get_tallies(session: Session, election_ids: Iterable[int]) -> Dict[int, int]:
+    """Returns a question option id -> vote count map for the given elections, in one query"""
+    stmt = (
+        sqlalchemy.select(OptionTally.question_option_id, OptionTally.votes)
+        .join(QuestionOption, QuestionOption.id == OptionTally.question_option_id)
+        .join(Question, Question.id == QuestionOption.question_id)
+        .where(Question.election_id.in_(list(election_ids)))
+    )
+    return {option_id: votes for option_id, votes in session.execute(stmt)}
+
+
+def get_voted_elections(
+    session: Session, kerberos: str, election_ids: Iterable[int]
+) -> Set[int]:
+    """Returns the subset of the given elections that this kerberos has voted in"""
+    stmt = (
+        sqlalchemy.select(Voter.election_id)
+        .where(Voter.kerberos == kerberos)
+        .where(Voter.election_id.in_(list(election_ids)))
+    )
+    return set(session.scalars(stmt))
+
+
+def rebuild_tallies(connection: sqlalchemy.Connection):
+    """Recomputes every tally from the raw votes table"""
+    connection.execute(sqlalchemy.delete(OptionTally))
+    connection.execute(
+        sqlalchemy.insert(OptionTally).from_select(
+            ["question_option_id", "votes"],
+            sqlalchemy.select(
+                Vote.question_option, sqlalchemy.func.count(Vote.id)
+            ).group_by(Vote.question_option),
+        )
+    )
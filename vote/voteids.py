@@ -0,0 +1,91 @@
+"""
+Primary keys for votes that cannot collide and are inserted in order, yet do
+not reveal the order votes were cast in.
+
+Votes are numbered by a counter stored in the database, and the numbers are
+split into blocks of 2^16. Within a block each number is mapped through a
+keyed permutation, so a block's ids are a shuffled run of consecutive
+integers. Inserts stay at the right edge of the votes B-tree, while a vote's
+id says nothing about when it was cast relative to the other votes in its
+block, or which votes came from the same ballot. All ids are above 2^32,
+where older versions stored random ids.
+
+The key comes from the vote_id_key setting and is never stored in the
+database. Anyone holding both the key and the database can recover the order
+of votes, and match it against the order of the voters table, so the key
+must not be kept with the database (csrf_key is, so it is not used as a
+fallback). If the key changes, numbering skips to a fresh block, since the
+new permutation could reuse ids of the current one.
+"""
+import functools
+import hashlib
+import hmac
+from typing import List, Union
+
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+from sqlalchemy.orm import Session
+
+from .models import *
+
+BLOCK_BITS = 16
+FIRST_ID = 1 << 32
+_ROUNDS = 4
+
+
+@functools.lru_cache(maxsize=4)
+def _round_tables(key: bytes, block: int) -> bytes:
+    seed = hmac.digest(key, b"vote-id block " + block.to_bytes(8, "big"), "sha256")
+    return hashlib.shake_256(seed).digest(_ROUNDS * 256)
+
+
+def vote_id(key: bytes, number: int) -> int:
+    """Returns the id of the vote with the given sequence number"""
+    block, offset = divmod(number, 1 << BLOCK_BITS)
+    tables = _round_tables(key, block)
+    # Balanced Feistel network over the two bytes of the offset
+    left, right = offset >> 8, offset & 0xFF
+    for r in range(_ROUNDS):
+        left, right = right, left ^ tables[r * 256 + right]
+    return FIRST_ID + (block << BLOCK_BITS) + ((left << 8) | right)
+
+
+class VoteIdAllocator:
+    def __init__(self, key: bytes):
+        self._key = key
+        self._key_check = hmac.digest(key, b"vote-id check", "sha256").hex()[:16]
+
+    @classmethod
+    def from_settings(cls, settings) -> "VoteIdAllocator":
+        if settings.vote_id_key == "":
+            raise RuntimeError("vote_id_key must be set, see the README")
+        if settings.vote_id_key == settings.csrf_key:
+            raise RuntimeError("vote_id_key must differ from csrf_key")
+        return cls(settings.vote_id_key.encode("utf-8"))
+
+    def allocate(
+        self, session: Union[Session, sqlalchemy.Connection], count: int
+    ) -> List[int]:
+        """Reserves count vote ids. Call inside the (write locked) transaction that inserts them."""
+        counter = session.execute(
+            sqlalchemy.select(VoteCounter.next_number, VoteCounter.key_check)
+        ).first()
+        if counter is None:
+            start = 0
+        elif counter.key_check != self._key_check:
+            block_size = 1 << BLOCK_BITS
+            start = -(-counter.next_number // block_size) * block_size
+        else:
+            start = counter.next_number
+        stmt = sqlalchemy.dialects.sqlite.insert(VoteCounter).values(
+            id=1, next_number=start + count, key_check=self._key_check
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[VoteCounter.id],
+            set_={
+                "next_number": stmt.excluded.next_number,
+                "key_check": stmt.excluded.key_check,
+            },
+        )
+        session.execute(stmt)
+        return [vote_id(self._key, number) for number in range(start, start + count)]
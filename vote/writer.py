@@ -0,0 +1,212 @@
+"""
+Single-writer pipeline that group-commits ballots.
+
+Request handlers validate a ballot and hand it to the BallotWriter, which
+runs one thread per process. The thread takes everything queued since its
+last commit and writes all of it in one BEGIN IMMEDIATE transaction, so a
+burst of ballots costs a few SQLite write transactions instead of one per
+voter, and lock contention between workers is resolved by the busy timeout
+instead of failing mid-transaction. Each submitter gets its own result.
+"""
+import concurrent.futures
+import dataclasses
+import datetime
+import enum
+import queue
+import random
+import threading
+from typing import Dict, List, Optional
+
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy.orm import Session
+
+from .models import *
+from .ranked import pack_ranking
+from .snapshots import FINALIZE_DELAY
+from .tally import record_votes
+from .voteids import VoteIdAllocator
+
+_random = random.SystemRandom()
+
+
+class BallotResult(enum.Enum):
+    ACCEPTED = "accepted"
+    # The voter already has a ballot recorded for this election
+    ALREADY_VOTED = "already_voted"
+    # The election's results were frozen before the ballot could be committed
+    CLOSED = "closed"
+
+
+@dataclasses.dataclass
+class _Submission:
+    kerberos: str
+    election_id: int
+    option_ids: List[int]
+    rankings: Dict[int, List[int]]
+    future: concurrent.futures.Future
+
+
+class BallotWriter:
+    # Times a failed batch is retried before its ballots are reported as failed
+    attempts = 3
+
+    def __init__(
+        self,
+        engine: sqlalchemy.Engine,
+        vote_ids: VoteIdAllocator,
+        batch_size: int = 500,
+    ):
+        self._engine = engine
+        self._vote_ids = vote_ids
+        self._batch_size = batch_size
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(
+        self,
+        kerberos: str,
+        election_id: int,
+        option_ids: List[int],
+        rankings: Optional[Dict[int, List[int]]] = None,
+    ) -> concurrent.futures.Future:
+        """Queues an already validated ballot. The future resolves to a BallotResult."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._ensure_started()
+        self._queue.put(
+            _Submission(kerberos, election_id, option_ids, rankings or {}, future)
+        )
+        return future
+
+    def stop(self):
+        """Commits anything still queued, then stops the writer thread"""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        # Started lazily so the thread belongs to the process that serves requests
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="ballot-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # Everything that queued up during the previous commit joins this one
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [s for s in batch if s is not None]
+            if len(batch) > 0:
+                self._commit_with_retry(batch)
+
+    def _commit_with_retry(self, batch: List[_Submission]):
+        for attempt in range(self.attempts):
+            try:
+                results = self._commit(batch)
+            except Exception as e:
+                retryable = isinstance(e, sqlalchemy.exc.SQLAlchemyError)
+                if not retryable or attempt + 1 == self.attempts:
+                    for submission in batch:
+                        submission.future.set_exception(e)
+                    return
+            else:
+                for submission, result in zip(batch, results):
+                    submission.future.set_result(result)
+                return
+
+    def _commit(self, batch: List[_Submission]) -> List[BallotResult]:
+        with Session(self._engine) as session:
+            # Take the write lock up front; upgrading a read transaction
+            # later fails immediately instead of waiting on the busy timeout
+            session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            keys = {(s.kerberos, s.election_id) for s in batch}
+            stmt = sqlalchemy.select(Voter.kerberos, Voter.election_id).where(
+                sqlalchemy.tuple_(Voter.kerberos, Voter.election_id).in_(keys)
+            )
+            voted = {tuple(row) for row in session.execute(stmt)}
+            # Ballots accepted just before the close still count until the
+            # results are frozen, but never after, or they would be left out
+            election_ids = {s.election_id for s in batch}
+            closed = set(
+                session.scalars(
+                    sqlalchemy.select(Election.id).where(
+                        Election.id.in_(election_ids),
+                        (
+                            Election.close_timestamp
+                            < datetime.datetime.now() - FINALIZE_DELAY
+                        )
+                        | Election.id.in_(
+                            sqlalchemy.select(ElectionSnapshot.election_id)
+                        ),
+                    )
+                )
+            )
+
+            results = []
+            accepted = []
+            for submission in batch:
+                key = (submission.kerberos, submission.election_id)
+                if submission.election_id in closed:
+                    results.append(BallotResult.CLOSED)
+                elif key in voted:
+                    results.append(BallotResult.ALREADY_VOTED)
+                else:
+                    voted.add(key)
+                    accepted.append(submission)
+                    results.append(BallotResult.ACCEPTED)
+
+            if len(accepted) > 0:
+                session.execute(
+                    sqlalchemy.insert(Voter),
+                    [
+                        {"kerberos": s.kerberos, "election_id": s.election_id}
+                        for s in accepted
+                    ],
+                )
+                options = [option for s in accepted for option in s.option_ids]
+                rankings = [r for s in accepted for r in s.rankings.items()]
+                if len(options) + len(rankings) > 0:
+                    # Also hide which votes came in together, in case the key leaks
+                    _random.shuffle(options)
+                    _random.shuffle(rankings)
+                    ids = self._vote_ids.allocate(session, len(options) + len(rankings))
+                    if len(options) > 0:
+                        session.execute(
+                            sqlalchemy.insert(Vote),
+                            [
+                                {"id": id, "question_option": option}
+                                for id, option in zip(ids, options)
+                            ],
+                        )
+                    if len(rankings) > 0:
+                        session.execute(
+                            sqlalchemy.insert(RankedBallot),
+                            [
+                                {
+                                    "id": id,
+                                    "question_id": question_id,
+                                    "ranking": pack_ranking(ranking),
+                                }
+                                for id, (question_id, ranking) in zip(
+                                    ids[len(options) :], rankings
+                                )
+                            ],
+                        )
+                    # First preferences are tallied like plurality votes, for turnout
+                    record_votes(session, options + [r[0] for _, r in rankings])
+            session.commit()
+        return results